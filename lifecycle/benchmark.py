@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+'''
+Offline benchmark for the lifecycle engine. It generates a synthetic tree of N prefixes, each holding a skewed number of objects of skewed sizes, writes delete actions for them and runs ``engine.main`` against the ``file`` backend. No bucket or cloud account is needed::
+
+  python3 benchmark.py --prefixes 5000 --objects 20
+  python3 benchmark.py --configurations 8:0,32:0,32:3 --skew 1.2
+
+Every configuration runs in its own process on a freshly generated copy of the same tree, so that the reported peak RSS is its own. A configuration is threads:list_shard_depth[:max_pending_actions].
+'''
+
+import argparse, json, multiprocessing, os, random, resource, shutil, sys, tempfile, time
+import engine
+
+def skewed(r, mean, skew, limit):
+    ''' Pareto distributed, so a few prefixes and objects are much larger than the rest, with the given mean. '''
+    return min(limit, max(1, int(mean * (skew - 1) / skew * r.paretovariate(skew))))
+
+def make_tree(folder, num_prefixes, objects, object_bytes, skew, depth, missing_fraction, actions_per_file, seed=0):
+    ''' Writes the objects under ``folder``/data and the actions under ``folder``/actions. Returns the number of objects. Objects are sparse files, so their size costs no disk writes. '''
+    r = random.Random(seed)
+    num_objects = 0
+    actions = []
+    for i in range(num_prefixes):
+        prefix = os.path.join(folder, 'data', f"prefix_{i}")
+        actions.append({'uri': 'file://' + prefix + '/', 'action_requested': 'delete'})
+        if r.random() < missing_fraction:
+            continue # already deleted by an earlier run
+        for j in range(skewed(r, objects, skew, 100 * objects)):
+            subfolder = os.path.join(prefix, *[ f"d{r.randrange(4)}" for _ in range(r.randrange(depth + 1)) ])
+            os.makedirs(subfolder, exist_ok=True)
+            with open(os.path.join(subfolder, f"part-{j:05d}"), 'w') as f:
+                f.truncate(skewed(r, object_bytes, skew, 1000 * object_bytes))
+            num_objects += 1
+    os.makedirs(os.path.join(folder, 'actions'))
+    for start in range(0, len(actions), actions_per_file):
+        with open(os.path.join(folder, 'actions', 'part-{:05d}'.format(start // actions_per_file)), 'w') as f:
+            for action in actions[start:start + actions_per_file]:
+                json.dump(action, f)
+                f.write('\n')
+    return num_objects
+
+def run_configuration(folder, configuration, output_part_bytes, results):
+    ''' Runs in a child process. Sends (actions/sec, objects/sec, failed actions, output seconds, peak RSS in MB) through ``results``. '''
+    threads, shard_depth, max_pending_actions = configuration
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1) # the engine logs every action
+    start = time.time()
+    engine.main(None, f"file://{folder}/actions/", f"file://{folder}/actions_complete/", threads, max_pending_actions,
+                output_part_bytes, 60, shard_depth)
+    seconds = time.time() - start
+    metrics = engine.metrics
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KB on Linux
+    results.put( (metrics['actions'] / seconds, metrics['objects_deleted'] / seconds, metrics['failed_actions'],
+                  metrics['output_seconds'], peak_rss_mb) )
+
+def parse_configuration(text):
+    parts = [ int(part) for part in text.split(':') ]
+    return (parts[0], parts[1], parts[2] if len(parts) > 2 else 10000)
+
+def main(prefixes, objects, object_bytes, skew, depth, missing_fraction, actions_per_file, output_part_bytes, configurations):
+    context = multiprocessing.get_context('fork')
+    print(f"{'threads':>7} {'shard depth':>11} {'pending':>8} {'actions/sec':>12} {'objects/sec':>12} {'failed':>7} {'output sec':>10} {'peak RSS MB':>12}")
+    for configuration in map(parse_configuration, configurations.split(',')):
+        folder = tempfile.mkdtemp()
+        num_objects = make_tree(folder, prefixes, objects, object_bytes, skew, depth, missing_fraction, actions_per_file)
+        print(f"Generated {prefixes} prefixes with {num_objects} objects", file=sys.stderr)
+        results = context.Queue()
+        process = context.Process(target=run_configuration, args=(folder, configuration, output_part_bytes, results))
+        process.start()
+        process.join()
+        label = f"{configuration[0]:7} {configuration[1]:11} {configuration[2]:8}"
+        if process.exitcode != 0:
+            print(f"{label} failed with exit code {process.exitcode}")
+        else:
+            actions_per_second, objects_per_second, failed, output_seconds, peak_rss_mb = results.get()
+            print(f"{label} {actions_per_second:12.1f} {objects_per_second:12.1f} {failed:7} {output_seconds:10.2f} {peak_rss_mb:12.1f}")
+        shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prefixes", type=int, default=2000)
+    parser.add_argument("--objects", type=int, default=10, help="mean objects per prefix")
+    parser.add_argument("--object_bytes", type=int, default=64*1024, help="mean object size")
+    parser.add_argument("--skew", type=float, default=1.5, help="pareto shape of the objects per prefix and object sizes, lower is more skewed")
+    parser.add_argument("--depth", type=int, default=2, help="most folders between a prefix and its objects")
+    parser.add_argument("--missing_fraction", type=float, default=0.05, help="fraction of the actions whose prefix is already gone")
+    parser.add_argument("--actions_per_file", type=int, default=10000)
+    parser.add_argument("--output_part_bytes", type=int, default=128*1024**2)
+    parser.add_argument("--configurations", default="1:0,8:0,32:0,32:3,64:3")
+    args = parser.parse_args()
+    main(**args.__dict__)
@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+'''
+The lifecycle engine shared by the lifecycle jobs. It reads the actions from ``--lifecycle.actions``, runs them on a pool of threads and writes them, completed, to ``--lifecycle.actions.complete``. The storage behind each URI protocol is a ``Backend`` plugin. ``s3_python/s3.py`` registers ``s3``, ``gcp/gs_bq.py`` registers ``gs`` and ``bq``, and ``file`` is built in.
+
+Deleting a prefix lists it one page at a time on a shared pool, splitting the listing on '/' so sub-prefixes are listed in parallel, and deletes the listed keys in batches as they arrive. Requests to each bucket go through an adaptive concurrency limit that backs off when the service throttles.
+
+Completed actions go to part-NNNNN files that roll over by size and age. The keys of the actions of each part go to _progress/part-NNNNN, so that a rerun skips the actions an earlier attempt completed.
+
+With ``--spark`` the actions run on the executors of a Spark cluster instead, see ``spark_engine.py``.
+
+With the ``file`` backend the engine runs without any cloud account::
+
+  python3 engine.py --lifecycle.actions file:///tmp/actions/ --lifecycle.actions.complete file:///tmp/actions_complete/
+'''
+
+import json, time, tempfile, os, datetime, shutil
+import multiprocessing.pool, threading, collections, concurrent.futures, contextlib, random, array, bisect, hashlib, re
+
+num_threads = 32 # all set by configure, the backends size their connection pools by num_threads
+shard_pool = None # lists and deletes the pages of all the actions
+max_pending_batches = 32 # per action
+list_shard_depth = 3
+max_concurrency = 32 # per bucket or dataset
+max_retries = 10
+limiters = {} # AdaptiveLimiter per bucket or dataset
+limiters_lock = threading.Lock()
+backends = {} # Backend instance per protocol
+backends_lock = threading.Lock()
+metrics = collections.Counter()
+metrics_lock = threading.Lock()
+
+def parse_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lifecycle.actions", dest='input_path')
+    parser.add_argument("--lifecycle.actions.complete", dest='output_path')
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--max_pending_actions", type=int, default=10000)
+    parser.add_argument("--output_part_bytes", type=int, default=128*1024**2)
+    parser.add_argument("--output_part_seconds", type=int, default=60)
+    parser.add_argument("--list_shard_depth", dest='shard_depth', type=int, default=3)
+    parser.add_argument("--spark", action='store_true', help="run the actions on the executors of the Spark cluster (emr_pyspark or dataproc_pyspark), or in local[*] mode without one")
+    parser.add_argument("--partitions", type=int, default=0, help="partitions of the actions with --spark, the default parallelism of the cluster by default")
+    parser.add_argument("--_args")
+    args, _ = parser.parse_known_args()
+    return args
+
+class AdaptiveLimiter(object):
+    ''' Limits the requests in flight to one bucket or dataset. The limit grows by one after every ``limit`` successful requests and halves when the service throttles, at most once per ``limit`` requests (AIMD), so it settles just under what the bucket or dataset allows. '''
+
+    def __init__(self, max_limit, initial_limit=4):
+        self.max_limit = max_limit
+        self.limit = min(initial_limit, max_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.last_decrease = 0
+        self.requests = 0
+        self.throttles = 0
+        self.start_time = time.time()
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify()
+
+    def succeeded(self):
+        with self.condition:
+            self.requests += 1
+            old_limit = int(self.limit)
+            self.limit = min(self.max_limit, self.limit + 1/self.limit)
+            if int(self.limit) > old_limit:
+                self.condition.notify()
+
+    def throttled(self):
+        with self.condition:
+            self.requests += 1
+            self.throttles += 1
+            # the requests already in flight at the last decrease were sent at the old limit
+            if self.requests - self.last_decrease > self.limit:
+                self.limit = max(1, self.limit/2)
+                self.last_decrease = self.requests
+
+    def report(self):
+        seconds = time.time() - self.start_time
+        return f"{self.requests} requests, {self.requests / seconds:.1f} per second, {self.throttles} throttled, concurrency {int(self.limit)}"
+
+def get_limiter(key):
+    with limiters_lock:
+        if key not in limiters:
+            limiters[key] = AdaptiveLimiter(max_concurrency)
+        return limiters[key]
+
+def backoff(attempt):
+    ''' Sleeps for a random time of up to 0.1 * 2**attempt seconds, capped at 20 seconds (full jitter). '''
+    time.sleep(random.uniform(0, min(20, 0.1 * 2**attempt)))
+
+def call_with_backoff(key, is_throttling, fn, *args, **kwargs):
+    ''' Calls ``fn`` within the concurrency limit of the bucket or dataset ``key``, retrying when ``is_throttling`` says the exception means the service throttles. '''
+    limiter = get_limiter(key)
+    for attempt in range(max_retries):
+        with limiter.slot():
+            try:
+                res = fn(*args, **kwargs)
+            except Exception as ex:
+                if not is_throttling(ex) or attempt == max_retries - 1:
+                    raise
+                limiter.throttled()
+            else:
+                limiter.succeeded()
+                return res
+        backoff(attempt)
+
+class Backend(object):
+    ''' The storage behind one URI protocol. Subclasses set ``protocol``, call ``register`` and implement ``list_page``, ``delete_batch``, ``download`` and ``upload``. Deleting anything other than a prefix of objects, such as a table, overrides ``delete``. One instance per protocol is shared by all the threads.
+
+    The engine sends ``list_page`` through ``call``, which applies the concurrency limit of the bucket and retries when ``is_throttling``. ``delete_batch`` uses ``call`` itself, so that it can retry only the keys that were throttled. '''
+
+    registered = {}
+    batch_size = 1000 # keys per delete_batch
+
+    @classmethod
+    def register(cls):
+        cls.registered[cls.protocol] = cls
+
+    @classmethod
+    def get(cls, uri):
+        protocol = uri.split(':',1)[0]
+        with backends_lock:
+            if protocol not in backends:
+                if protocol not in cls.registered:
+                    raise Exception(f"{protocol} is not a registered lifecycle backend. Only found {sorted(cls.registered)}")
+                backends[protocol] = cls.registered[protocol]()
+            return backends[protocol]
+
+    def split(self, uri):
+        ''' Returns the bucket and the prefix of the uri. '''
+        _, _, bucket, prefix = uri.split('/',3)
+        return bucket, prefix
+
+    def is_throttling(self, ex):
+        return False
+
+    def call(self, bucket, fn, *args, **kwargs):
+        return call_with_backoff(f"{self.protocol}://{bucket}", self.is_throttling, fn, *args, **kwargs)
+
+    def list_page(self, bucket, prefix, token, delimited, max_keys=1000):
+        ''' Lists one page of up to ``max_keys`` keys, split on '/' if ``delimited``. Returns the keys, the sub-prefixes and the token of the next page, or None. '''
+        raise NotImplementedError
+
+    def delete_batch(self, bucket, keys):
+        ''' Deletes up to ``batch_size`` keys. Keys that are gone already count as deleted. Returns error messages. '''
+        raise NotImplementedError
+
+    def download(self, bucket, key, filename):
+        raise NotImplementedError
+
+    def upload(self, filename, bucket, key):
+        raise NotImplementedError
+
+    def list_keys(self, bucket, prefix):
+        token = None
+        while True:
+            keys, _, token = self.call(bucket, self.list_page, bucket, prefix, token, False)
+            yield from keys
+            if token is None:
+                return
+
+    def is_empty(self, bucket, prefix):
+        keys, _, _ = self.call(bucket, self.list_page, bucket, prefix, None, False, 1)
+        return not keys
+
+    def delete(self, uri):
+        ''' Deletes everything under the uri. Returns whether it was empty before, the error messages and whether it is empty after. '''
+        bucket, prefix = self.split(uri)
+        num_objects, errors = delete_prefix(self, bucket, prefix)
+        print(f"Deleted {num_objects} objects from {uri}")
+        return num_objects == 0, errors, self.is_empty(bucket, prefix)
+
+class FileBackend(Backend):
+    ''' Local files, as file:///path/. Keys are absolute paths and prefixes match them as strings, like in object stores. For testing and benchmarks. '''
+
+    protocol = 'file'
+
+    def split(self, uri):
+        return '', uri[len('file://'):]
+
+    def list_page(self, bucket, prefix, token, delimited, max_keys=1000):
+        folder = prefix if prefix.endswith('/') else os.path.dirname(prefix) + '/'
+        entries = []
+        if delimited:
+            if os.path.isdir(folder):
+                for entry in os.scandir(folder):
+                    if entry.path.startswith(prefix):
+                        entries.append( entry.path + '/' if entry.is_dir() else entry.path )
+        else:
+            for dirpath, _, filenames in os.walk(folder):
+                entries += [ path for path in (os.path.join(dirpath, f) for f in filenames) if path.startswith(prefix) ]
+        entries.sort()
+        if token is not None:
+            entries = entries[bisect.bisect_right(entries, token):]
+        page = entries[:max_keys]
+        next_token = page[-1] if len(entries) > max_keys else None
+        return ([ e for e in page if not e.endswith('/') ], [ e for e in page if e.endswith('/') ], next_token)
+
+    def delete_batch(self, bucket, keys):
+        return self.call(bucket, self.remove_files, keys)
+
+    def remove_files(self, keys):
+        errors = []
+        for key in keys:
+            try:
+                os.remove(key)
+            except FileNotFoundError:
+                pass
+            except OSError as ex:
+                errors.append(f"{key}: {ex}")
+        return errors
+
+    def download(self, bucket, key, filename):
+        shutil.copyfile(key, filename)
+
+    def upload(self, filename, bucket, key):
+        os.makedirs(os.path.dirname(key), exist_ok=True)
+        shutil.copyfile(filename, key)
+
+    def delete(self, uri):
+        res = super().delete(uri)
+        # object stores have no folders to leave behind
+        _, prefix = self.split(uri)
+        if prefix.endswith('/') and os.path.isdir(prefix):
+            for dirpath, _, _ in sorted(os.walk(prefix), reverse=True):
+                with contextlib.suppress(OSError):
+                    os.rmdir(dirpath)
+        return res
+FileBackend.register()
+
+def delete_prefix(backend, bucket, prefix):
+    ''' Deletes every key under the prefix. Down to ``list_shard_depth`` levels, the listing is split on '/' and every sub-prefix is listed as a separate task on ``shard_pool``. The keys are deleted there in batches as soon as they are listed. Returns the number of keys found and the error messages. '''
+    num_keys = 0
+    errors = []
+    def list_page(page_prefix, token, depth):
+        return backend.call(bucket, backend.list_page, bucket, page_prefix, token, depth < list_shard_depth)
+    listings = collections.deque([ (prefix, 0, shard_pool.submit(list_page, prefix, None, 0)) ])
+    deletes = collections.deque()
+    batch = []
+    while listings:
+        page_prefix, depth, future = listings.popleft()
+        keys, sub_prefixes, token = future.result()
+        if token is not None:
+            listings.append( (page_prefix, depth, shard_pool.submit(list_page, page_prefix, token, depth)) )
+        for sub_prefix in sub_prefixes:
+            listings.append( (sub_prefix, depth+1, shard_pool.submit(list_page, sub_prefix, None, depth+1)) )
+        num_keys += len(keys)
+        # small sub-prefixes are gathered into full batches
+        batch += keys
+        while len(batch) >= backend.batch_size or (batch and not listings):
+            deletes.append(shard_pool.submit(backend.delete_batch, bucket, batch[:backend.batch_size]))
+            batch = batch[backend.batch_size:]
+        while len(deletes) > max_pending_batches:
+            errors += deletes.popleft().result()
+    while deletes:
+        errors += deletes.popleft().result()
+    with metrics_lock:
+        metrics['objects_deleted'] += num_keys
+    return num_keys, errors
+
+def do_action(action):
+    # fill in before_state, after_state, action_completed_ts (if SUCCESS) , error_message (if FAILED)
+    if action['action_requested'] == 'delete':
+        start_time = time.time()
+        try:
+            was_empty, errors, is_empty = Backend.get(action['uri']).delete(action['uri'])
+        except Exception as ex:
+            action['before_state'] = []
+            action['after_state'] = []
+            action['error_message'] = f"{type(ex).__name__}: {ex}"
+            return action
+        action['before_state'] = [ ('empty' if was_empty else 'not_empty') ]
+        action['after_state'] = [ ('empty' if is_empty else 'not_empty') ]
+        if errors or not is_empty:
+            messages = errors[:10]
+            if len(errors) > 10:
+                messages.append(f"and {len(errors) - 10} more errors")
+            if not is_empty:
+                messages.append("objects remain under the prefix")
+            action['error_message'] = "; ".join(messages)
+        else:
+            action['action_completed_ts'] = str(datetime.datetime.utcnow())
+        print(f"{action['uri']} took {time.time() - start_time:.2f} seconds")
+    else:
+        action['before_state'] = []
+        action['after_state'] = []
+        action['error_message'] = action['action_requested'] + " is not a valid action"
+    return action
+
+def action_key(action):
+    return action['action_requested'] + ' ' + action['uri']
+
+class ProgressJournal(object):
+    ''' The actions completed by earlier attempts, kept as a sorted array of 64 bit hashes of their keys: 8 bytes per action. '''
+
+    def __init__(self):
+        self.hashes = array.array('Q')
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+    def add(self, key):
+        self.hashes.append(self.hash(key))
+
+    def freeze(self):
+        self.hashes = array.array('Q', sorted(self.hashes))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, action):
+        h = self.hash(action_key(action))
+        i = bisect.bisect_left(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+class OutputParts(object):
+    ''' Writes completed actions as JSON lines into part-NNNNN files, handing each one to ``upload(filename, part_name)`` once it reaches ``part_bytes`` or has been open for ``part_seconds``. The keys of the actions in a part are then uploaded to _progress/part-NNNNN, the journal a rerun skips completed actions with. Only the part being written is kept, on local disk. '''
+
+    def __init__(self, upload, part_bytes, part_seconds, part_num=0, part_step=1):
+        self.upload = upload
+        self.part_bytes = part_bytes
+        self.part_seconds = part_seconds
+        self.folder = tempfile.mkdtemp()
+        self.part_num = part_num
+        self.part_step = part_step # writers sharing an output number their parts part_num, part_num + part_step, ...
+        self.f = None
+
+    def write(self, action):
+        if self.f is None:
+            self.filename = os.path.join(self.folder, 'part-{:05d}'.format(self.part_num))
+            self.f = open(self.filename, 'w')
+            self.keys = []
+            self.opened_at = time.time()
+        self.f.write(json.dumps(action))
+        self.f.write('\n')
+        self.keys.append(action_key(action))
+        if self.f.tell() >= self.part_bytes or time.time() - self.opened_at >= self.part_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.f is not None:
+            self.f.close()
+            part_name = os.path.basename(self.filename)
+            self.upload(self.filename, part_name)
+            with open(self.filename, 'w') as f:
+                for key in self.keys:
+                    f.write(key)
+                    f.write('\n')
+            self.upload(self.filename, '_progress/' + part_name)
+            os.remove(self.filename)
+            self.f = None
+            self.part_num += self.part_step
+
+    def close(self):
+        self.flush()
+        os.rmdir(self.folder)
+
+def run_actions(pool, actions, max_pending):
+    ''' Yields the completed actions in the order they finish. The pool reads ``actions`` only as far as ``max_pending`` actions ahead of the consumer. '''
+    semaphore = threading.Semaphore(max_pending)
+    stopped = threading.Event()
+    def bounded():
+        for action in actions:
+            semaphore.acquire()
+            if stopped.is_set():
+                return
+            yield action
+    try:
+        for action in pool.imap_unordered(do_action, bounded()):
+            semaphore.release()
+            yield action
+    finally:
+        # let the pool stop reading when the consumer gives up early
+        stopped.set()
+        semaphore.release()
+
+def read_action_file(backend, bucket, key):
+    ''' Yields the actions of one action file, one line at a time. '''
+    print("Processing action file w prefix "+ key)
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        backend.download(bucket, key, filename)
+        with open(filename) as f:
+            for line in f:
+                yield json.loads(line)
+    finally:
+        os.remove(filename)
+
+def read_actions(backend, bucket, prefix):
+    ''' Yields the actions of every action file under the prefix. '''
+    for key in backend.list_keys(bucket, prefix):
+        yield from read_action_file(backend, bucket, key)
+
+def read_progress(backend, bucket, prefix):
+    ''' Loads the actions completed by earlier attempts from the output under the prefix. The keys of a part are read from its _progress/ file, or from the part itself if the attempt died before writing that. Returns the journal and the number of the next part. '''
+    names = set( key[len(prefix):] for key in backend.list_keys(bucket, prefix) )
+    parts = sorted( (name for name in names if re.fullmatch(r'part-\d{5,}', name)), key=lambda name: int(name[len('part-'):]) )
+    journal = ProgressJournal()
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    for part in parts:
+        if '_progress/' + part in names:
+            backend.download(bucket, prefix + '_progress/' + part, filename)
+            with open(filename) as f:
+                for line in f:
+                    journal.add(line.rstrip('\n'))
+        else:
+            backend.download(bucket, prefix + part, filename)
+            with open(filename) as f:
+                for line in f:
+                    journal.add(action_key(json.loads(line)))
+    os.remove(filename)
+    journal.freeze()
+    return journal, (int(parts[-1][len('part-'):]) + 1 if parts else 0)
+
+def print_metrics(start_time):
+    seconds = time.time() - start_time
+    with metrics_lock:
+        print(f"Completed {metrics['actions']} actions ({metrics['failed_actions']} failed) and deleted {metrics['objects_deleted']} objects in {seconds:.1f} seconds: "
+              f"{metrics['actions'] / seconds:.1f} actions and {metrics['objects_deleted'] / seconds:.1f} objects per second, "
+              f"{metrics['output_seconds']:.1f} seconds writing the output")
+    with limiters_lock:
+        for key, limiter in sorted(limiters.items()):
+            print(f"{key}: {limiter.report()}")
+
+def configure(threads, shard_depth):
+    ''' Sets the concurrency of the engine in this process and starts the pool listing and deleting pages, unless an earlier call did. '''
+    global num_threads, shard_pool, max_pending_batches, list_shard_depth, max_concurrency
+    num_threads = threads
+    list_shard_depth = shard_depth
+    max_concurrency = threads
+    max_pending_batches = threads
+    if shard_pool is None:
+        shard_pool = concurrent.futures.ThreadPoolExecutor(threads)
+
+def complete_actions(pool, actions, output, max_pending_actions, start_time):
+    ''' Runs the actions on the pool and writes them to ``output`` as they complete, counting them in the metrics. '''
+    for action in run_actions(pool, actions, max_pending_actions):
+        output_start = time.time()
+        output.write(action)
+        with metrics_lock:
+            metrics['actions'] += 1
+            metrics['failed_actions'] += 'error_message' in action
+            metrics['output_seconds'] += time.time() - output_start
+        if metrics['actions'] % 10000 == 0:
+            print_metrics(start_time)
+    output_start = time.time()
+    output.close()
+    metrics['output_seconds'] += time.time() - output_start
+
+def main(_args, input_path, output_path, threads, max_pending_actions, output_part_bytes, output_part_seconds, shard_depth, spark=False, partitions=0):
+    global shard_pool
+    if spark:
+        import spark_engine
+        return spark_engine.main(input_path, output_path, threads, max_pending_actions, output_part_bytes, output_part_seconds, shard_depth, partitions)
+    configure(threads, shard_depth)
+    metrics.clear()
+    start_time = time.time()
+    # the actions only wait on storage services, so threads sharing the clients of the backends are enough
+    pool = multiprocessing.pool.ThreadPool(processes=threads)
+
+    input_backend = Backend.get(input_path)
+    bucket, prefix = input_backend.split(input_path)
+    output_backend = Backend.get(output_path)
+    output_bucket, output_prefix = output_backend.split(output_path)
+    journal, part_num = read_progress(output_backend, output_bucket, output_prefix)
+    if journal:
+        print(f"Skipping the {len(journal)} actions completed by earlier attempts")
+    output = OutputParts(lambda filename, part_name: output_backend.upload(filename, output_bucket, output_prefix+part_name),
+                         output_part_bytes, output_part_seconds, part_num)
+    actions = ( action for action in read_actions(input_backend, bucket, prefix) if action not in journal )
+    complete_actions(pool, actions, output, max_pending_actions, start_time)
+    pool.close()
+    shard_pool.shutdown()
+    shard_pool = None
+    print_metrics(start_time)
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(**args.__dict__)
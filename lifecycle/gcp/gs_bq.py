@@ -1,5 +1,7 @@
 '''
-This file is able to handle Google Storage and BigQuery lifecycle actions. Use the registration file provided.
+This file is able to handle Google Storage and BigQuery lifecycle actions. Use the registration file provided. It plugs the ``gs`` and ``bq`` backends into the lifecycle engine in ``../engine.py``.
+
+It needs google-cloud-storage 2.10 or later, whose batch requests report the outcome of every call.
 
 Testing steps:
 
@@ -11,98 +13,133 @@ Testing steps:
 
 '''
 
-import json, time, sys, yaml, boto3, tempfile, os, datetime, subprocess
-import multiprocessing.pool
+import json, sys, tempfile, os, subprocess
+import threading, requests.adapters
 import treldev.gcputils
+from google.api_core.exceptions import NotFound, from_http_response
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import engine
+from engine import parse_args, main
 
-def parse_args():
-    import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--lifecycle.actions", dest='input_path')
-    parser.add_argument("--lifecycle.actions.complete", dest='output_path')
-    parser.add_argument("--threads", type=int, default=100)
-    parser.add_argument("--_args")
-    args, _ = parser.parse_known_args()
-    return args
-
-def do_action(action):
-    # fill in before_state, after_state, action_completed_ts (if SUCCESS) , error_message (if FAILED)
-    if action['action_requested'] == 'delete':
-        protocol,_ = action['uri'].split(':',1)
-        if protocol == 'bq':
-            bquri = treldev.gcputils.BigQueryURI(action['uri'])
-            try:
-                bqclient.delete_table(bquri.path)
-                print(f"Deleting {bquri.uri}")
-                empty = False
-            except:
-                empty = True
-        elif protocol == 'gs':
-            _, _, bucket, prefix = action['uri'].split('/',3)
-            bucket_obj = None
+throttling_reasons = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+def is_throttling(ex):
+    code = getattr(ex, 'code', None)
+    if code in (429, 500, 502, 503, 504):
+        return True
+    return code == 403 and any(error.get('reason') in throttling_reasons for error in getattr(ex, 'errors', []))
+
+def size_connection_pool(client):
+    ''' The threads share the clients, so their HTTP connection pools need a connection per thread. '''
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2*engine.num_threads, pool_maxsize=2*engine.num_threads)
+    client._http.mount("https://", adapter)
+
+def error_message(response):
+    try:
+        return response.json()['error']['message']
+    except (ValueError, KeyError, TypeError):
+        return response.text
+
+def check_batch_responses(client):
+    ''' ``GSBackend.delete_batch`` reads the response of each call from ``Batch._responses``, which google-cloud-storage sets when a batch finishes since 2.10 (checked up to 3.17). Fails at startup if that is gone, rather than miscounting deletes. '''
+    batch = client.batch(raise_exception=False)
+    if not isinstance(getattr(batch, '_responses', None), list):
+        raise Exception("GSBackend needs google-cloud-storage 2.10 or later, whose batches keep the response of every call in _responses")
+
+class GSBackend(engine.Backend):
+
+    protocol = 'gs'
+    batch_size = 100 # the most calls a batch request takes
+
+    def __init__(self):
+        self.client = treldev.gcputils.Storage.get_client()
+        size_connection_pool(self.client)
+        self.batch_clients = threading.local()
+        check_batch_responses(self.client)
+
+    def is_throttling(self, ex):
+        return is_throttling(ex)
+
+    def get_batch_client(self):
+        ''' Open batches are tracked on the client, so each thread sending batches needs a client of its own. '''
+        if not hasattr(self.batch_clients, 'client'):
+            self.batch_clients.client = treldev.gcputils.Storage.get_client()
+        return self.batch_clients.client
+
+    def list_page(self, bucket, prefix, token, delimited, max_keys=1000):
+        iterator = self.client.list_blobs(bucket, prefix=prefix, page_token=token, page_size=max_keys,
+                                          delimiter=('/' if delimited else None),
+                                          fields='items(name),prefixes,nextPageToken')
+        page = next(iterator.pages, None)
+        if page is None:
+            return [], [], None
+        return [ blob.name for blob in page ], sorted(page.prefixes), iterator.next_page_token
+
+    def delete_batch(self, bucket, names):
+        ''' Deletes up to 100 blobs with one batch request. Each call of the batch has a response of its own. Blobs that are gone already count as deleted and the ones that fail because GCS throttles are retried. '''
+        client = self.get_batch_client()
+        bucket_obj = client.bucket(bucket)
+        def send(names):
+            batch = client.batch(raise_exception=False)
+            with batch:
+                for name in names:
+                    bucket_obj.delete_blob(name)
+            if len(batch._responses) != len(names):
+                raise Exception(f"Got {len(batch._responses)} responses to a batch of {len(names)} deletes")
+            return batch._responses # one per call, in order
+        errors = []
+        for attempt in range(engine.max_retries):
             try:
-                bucket_obj = sclient.bucket(bucket)
-            except:
-                print(f"Unable to find google storage bucket {bucket}", out=sys.stderr)
-            if bucket_obj:
-                empty = True
-                for blob in bucket_obj.list_blobs(prefix=prefix):
-                    blob.delete()
-                    print(f"Deleting gs://{bucket}/{blob.name}")
-                    empty=False
-        action['action_completed_ts'] = str(datetime.datetime.utcnow())
-        action['before_state'] = [ ('empty' if empty else 'not_empty') ]
-        action['after_state'] = ['empty']
-    else:
-        action['before_state'] = []
-        action['after_state'] = []
-        action['error_message'] = s3_action['action_requested'] + " is not a valid action"
-    return action
-        
-def main(_args, input_path, output_path, threads):
-    global bqclient, sclient
-    bqclient = treldev.gcputils.BigQuery.get_client()
-    sclient = treldev.gcputils.Storage.get_client()
-    
-    start_time = time.time()
-    pool = multiprocessing.pool.Pool(processes=threads)
-    fd, filename = tempfile.mkstemp()
-    output_folder = tempfile.mkdtemp()
+                responses = self.call(bucket, send, names)
+            except Exception as ex:
+                return errors + [ f"gs://{bucket}/{names[0]} and {len(names) - 1} more: {ex}" ]
+            throttled = []
+            for name, response in zip(names, responses):
+                if response.status_code < 300 or response.status_code == 404:
+                    continue
+                ex = from_http_response(response)
+                if is_throttling(ex):
+                    throttled.append(name)
+                else:
+                    errors.append(f"gs://{bucket}/{name}: {response.status_code} {error_message(response)}")
+            names = throttled
+            if not names:
+                return errors
+            engine.get_limiter(f"gs://{bucket}").throttled()
+            engine.backoff(attempt)
+        return errors + [ f"gs://{bucket}/{name}: still throttled after {engine.max_retries} attempts" for name in names ]
 
+    def download(self, bucket, key, filename):
+        self.client.bucket(bucket).blob(key).download_to_filename(filename)
 
-    input_protocol,_,bucket, prefix = input_path.split('/',3)
-    output_protocol,_,output_bucket, output_prefix = output_path.split('/',3)
-    assert input_protocol == 'gs:'
-    assert output_protocol == 'gs:'
-    res = []
-    i = 0
-    output_bucket_obj = sclient.bucket(output_bucket)
-    for blob in sclient.list_blobs(bucket,prefix=prefix):
-        print("Processing action file w prefix "+ blob.name)
-        with open(filename,'wb') as f:
-            sclient.download_blob_to_file(blob,f)
-        subset = []
-        with open(filename) as f:
-            for line in f:
-                subset.append( json.loads(line) )
-                if len(subset) == 10000:
-                    print("Asking pool to process a subset of length {}".format(len(subset)))
-                    res += pool.map(do_action, subset)
-                    subset.clear()
-        print("Asking pool to process a subset of length {}".format(len(subset)))
-        res += pool.map(do_action, subset)
-        output_filename = 'part-{:05d}'.format(i)
-        full_output_filename = os.path.join(output_folder, output_filename)
-        with open(full_output_filename,'w') as f:
-            for v in res:
-                f.write(json.dumps(v))
-                f.write('\n')
-        output_blob = output_bucket_obj.blob(output_prefix+output_filename)
-        output_blob.upload_from_filename(full_output_filename)
-        os.system("rm {0}".format(full_output_filename))
-        i += 1
-    os.close(fd)
-    print("Execution took {} seconds".format(time.time() - start_time))
+    def upload(self, filename, bucket, key):
+        self.client.bucket(bucket).blob(key).upload_from_filename(filename)
+
+    def delete(self, uri):
+        try:
+            return super().delete(uri)
+        except NotFound:
+            print(f"Unable to find google storage bucket {self.split(uri)[0]}", file=sys.stderr)
+            return True, [], True
+GSBackend.register()
+
+class BQBackend(engine.Backend):
+
+    protocol = 'bq'
+
+    def __init__(self):
+        self.client = treldev.gcputils.BigQuery.get_client()
+        size_connection_pool(self.client)
+
+    def delete(self, uri):
+        bquri = treldev.gcputils.BigQueryURI(uri)
+        try:
+            engine.call_with_backoff(f"bq://{bquri.project}/{bquri.dataset}", is_throttling, self.client.delete_table, bquri.path)
+            print(f"Deleting {bquri.uri}")
+            return False, [], True
+        except NotFound:
+            return True, [], True
+BQBackend.register()
 
 def test_gs(temp_gs_path, num_paths=20, num_files=10):
     assert 'tmp/' in temp_gs_path
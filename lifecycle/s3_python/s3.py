@@ -1,73 +1,56 @@
-import json, time, sys, yaml, boto3, tempfile, os, datetime
-import multiprocessing.pool
+import json, sys, boto3, tempfile, os
+from botocore.config import Config
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import engine
+from engine import parse_args, main
 
-def parse_args():
-    import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--lifecycle.actions", dest='input_path')
-    parser.add_argument("--lifecycle.actions.complete", dest='output_path')
-    parser.add_argument("--_args")
-    args, _ = parser.parse_known_args()
-    return args
+class S3Backend(engine.Backend):
 
-def do_action(s3_action):
-    s3 = boto3.resource('s3')
-    # fill in before_state, after_state, action_completed_ts (if SUCCESS) , error_message (if FAILED)
-    if s3_action['action_requested'] == 'delete':
-        _,_,bucket, prefix = s3_action['uri'].split('/',3)
-        s3_bucket = s3.Bucket(bucket)
-        empty = True
-        for s3_object in s3_bucket.objects.filter(Prefix=prefix):
-            print("Deleting ",s3_object.key)
-            s3_object.delete()
-            s3_object.wait_until_not_exists()
-            empty = False
-        s3_action['action_completed_ts'] = str(datetime.datetime.utcnow())
-        s3_action['before_state'] = [ ('empty' if empty else 'not_empty') ]
-        s3_action['after_state'] = ['empty']
-    else:
-        s3_action['before_state'] = []
-        s3_action['after_state'] = []
-        s3_action['error_message'] = s3_action['action_requested'] + " is not a valid action"
-    return s3_action
-        
-def main(_args, input_path, output_path):
-    start_time = time.time()
-    pool = multiprocessing.pool.Pool(processes=100)
-    fd, filename = tempfile.mkstemp()
-    output_folder = tempfile.mkdtemp()
-    
-    s3 = boto3.resource('s3')
-    _,_,bucket, prefix = input_path.split('/',3)
-    _,_,output_bucket, output_prefix = output_path.split('/',3)
-    res = []
-    i = 0
-    s3_output_bucket = s3.Bucket(output_bucket)
-    s3_bucket = s3.Bucket(bucket)
-    for s3_object in s3_bucket.objects.filter(Prefix=prefix):
-        print("Processing action file w prefix "+ s3_object.key)
-        s3_bucket.download_file(s3_object.key,filename)
-        subset = []
-        with open(filename) as f:
-            for line in f:
-                subset.append( json.loads(line) )
-                if len(subset) == 10000:
-                    print("Asking pool to process a subset of length {}".format(len(subset)))
-                    res += pool.map(do_action, subset)
-                    subset.clear()
-        print("Asking pool to process a subset of length {}".format(len(subset)))
-        res += pool.map(do_action, subset)
-        output_filename = 'part-{:05d}'.format(i)
-        full_output_filename = os.path.join(output_folder, output_filename)
-        with open(full_output_filename,'w') as f:
-            for v in res:
-                f.write(json.dumps(v))
-                f.write('\n')
-        s3_output_bucket.upload_file(full_output_filename,output_prefix+output_filename)
-        os.close(fd)
-        os.system("rm {0}".format(full_output_filename))
-        i += 1
-    print("Execution took {} seconds".format(time.time() - start_time))
+    protocol = 's3'
+    throttling_codes = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                        'ServiceUnavailable', 'InternalError', 'RequestTimeout', '500', '503'}
+
+    def __init__(self):
+        self.client = boto3.client('s3', config=Config(max_pool_connections=2*engine.num_threads))
+
+    def is_throttling(self, ex):
+        return getattr(ex, 'response', {}).get('Error', {}).get('Code') in self.throttling_codes
+
+    def list_page(self, bucket, prefix, token, delimited, max_keys=1000):
+        kwargs = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': max_keys}
+        if token is not None:
+            kwargs['ContinuationToken'] = token
+        if delimited:
+            kwargs['Delimiter'] = '/'
+        res = self.client.list_objects_v2(**kwargs)
+        keys = [ obj['Key'] for obj in res.get('Contents', []) ]
+        sub_prefixes = [ p['Prefix'] for p in res.get('CommonPrefixes', []) ]
+        return keys, sub_prefixes, res.get('NextContinuationToken')
+
+    def delete_batch(self, bucket, keys):
+        ''' Deletes up to 1000 keys with one DeleteObjects request. Keys that fail because S3 throttles are retried. '''
+        errors = []
+        for attempt in range(engine.max_retries):
+            res = self.call(bucket, self.client.delete_objects, Bucket=bucket,
+                            Delete={'Objects': [ {'Key': key} for key in keys ], 'Quiet': True})
+            keys = []
+            for error in res.get('Errors', []):
+                if error['Code'] in self.throttling_codes:
+                    keys.append(error['Key'])
+                else:
+                    errors.append("{Key}: {Code} {Message}".format(**error))
+            if not keys:
+                return errors
+            engine.get_limiter(f"s3://{bucket}").throttled()
+            engine.backoff(attempt)
+        return errors + [ "{}: SlowDown still throttled after {} attempts".format(key, engine.max_retries) for key in keys ]
+
+    def download(self, bucket, key, filename):
+        self.client.download_file(bucket, key, filename)
+
+    def upload(self, filename, bucket, key):
+        self.client.upload_file(filename, bucket, key)
+S3Backend.register()
 
 def test(temp_s3_path, num_paths=20, num_files=10):
     temp_folder = tempfile.mkdtemp()
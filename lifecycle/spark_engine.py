@@ -0,0 +1,85 @@
+'''
+Runs the lifecycle engine on a Spark cluster, for the emr_pyspark and dataproc_pyspark execution profiles. The lifecycle jobs switch to it with ``--spark``::
+
+  spark-submit s3.py --lifecycle.actions s3://bucket/actions/ --lifecycle.actions.complete s3://bucket/actions_complete/ --spark
+
+The driver lists the action files and loads the progress of earlier attempts. The executors download the action files, skipping the completed actions, and the actions are repartitioned so every core gets a share even when there are few action files. Each partition runs its actions on the threads of the engine and uploads its own output parts. The backends, with their clients and concurrency limits, are shared by the tasks a Python worker runs.
+
+Without a cluster it runs in local[*] mode, e.g. with the ``file`` backend::
+
+  python3 engine.py --lifecycle.actions file:///tmp/actions/ --lifecycle.actions.complete file:///tmp/actions_complete/ --spark
+'''
+
+import collections, functools, importlib, multiprocessing.pool, os, sys, time
+import engine
+
+def backend_modules():
+    ''' Returns the module name and file of every module that registered a backend, so the executors can import them to register them too. '''
+    modules = {}
+    for cls in engine.Backend.registered.values():
+        filename = os.path.abspath(sys.modules[cls.__module__].__file__)
+        modules[os.path.splitext(os.path.basename(filename))[0]] = filename # the job's own module is __main__ on the driver
+    return modules
+
+def start_worker(modules, threads, shard_depth):
+    for name in modules:
+        importlib.import_module(name)
+    engine.configure(threads, shard_depth)
+
+def read_action_file(settings, input_path, journal, key):
+    start_worker(*settings)
+    backend = engine.Backend.get(input_path)
+    bucket, _ = backend.split(input_path)
+    for action in engine.read_action_file(backend, bucket, key):
+        if action not in journal.value:
+            yield action
+
+def run_partition(settings, output_path, part_num, num_partitions, max_pending_actions, output_part_bytes, output_part_seconds, index, actions):
+    ''' Completes the actions of one partition into the parts part_num + index, part_num + index + num_partitions, ... Yields the metrics of the partition. '''
+    start_worker(*settings)
+    engine.metrics.clear()
+    start_time = time.time()
+    backend = engine.Backend.get(output_path)
+    bucket, prefix = backend.split(output_path)
+    output = engine.OutputParts(lambda filename, part_name: backend.upload(filename, bucket, prefix+part_name),
+                                output_part_bytes, output_part_seconds, part_num + index, num_partitions)
+    pool = multiprocessing.pool.ThreadPool(processes=engine.num_threads)
+    try:
+        engine.complete_actions(pool, actions, output, max_pending_actions, start_time)
+    finally:
+        pool.close()
+    engine.print_metrics(start_time)
+    yield dict(engine.metrics)
+
+def main(input_path, output_path, threads, max_pending_actions, output_part_bytes, output_part_seconds, shard_depth, partitions):
+    from pyspark.sql import SparkSession
+    spark = SparkSession.builder.appName('lifecycle').getOrCreate()
+    sc = spark.sparkContext
+    start_time = time.time()
+    modules = backend_modules()
+    for filename in sorted(set(modules.values()) | {os.path.abspath(__file__)}):
+        sc.addPyFile(filename)
+    settings = (sorted(modules), threads, shard_depth)
+    engine.configure(threads, shard_depth)
+
+    input_backend = engine.Backend.get(input_path)
+    bucket, prefix = input_backend.split(input_path)
+    keys = list(input_backend.list_keys(bucket, prefix))
+    output_backend = engine.Backend.get(output_path)
+    output_bucket, output_prefix = output_backend.split(output_path)
+    journal, part_num = engine.read_progress(output_backend, output_bucket, output_prefix)
+    if journal:
+        print(f"Skipping the {len(journal)} actions completed by earlier attempts")
+    partitions = partitions or sc.defaultParallelism
+    print(f"Running the actions of {len(keys)} action files in {partitions} partitions")
+
+    actions = sc.parallelize(keys, max(1, len(keys))) \
+                .flatMap(functools.partial(read_action_file, settings, input_path, sc.broadcast(journal))) \
+                .repartition(partitions)
+    totals = collections.Counter()
+    for metrics in actions.mapPartitionsWithIndex(functools.partial(run_partition, settings, output_path, part_num, partitions, max_pending_actions,
+                                                                    output_part_bytes, output_part_seconds)).collect():
+        totals.update(metrics)
+    engine.metrics.clear()
+    engine.metrics.update(totals)
+    engine.print_metrics(start_time)
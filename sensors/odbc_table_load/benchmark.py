@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+'''
+Offline benchmark for the ODBC sensor. It runs ``ODBCSensor.save_data_to_path`` end to end against a synthetic SQLite table, read through a pyodbc compatible wrapper, and writes to a ``file://`` destination. No database server, S3 or BigQuery is needed::
+
+  python3 benchmark.py --rows 500000 --columns 40
+  python3 benchmark.py --types integer,varchar --combinations json:gz,parquet:snappy,json:zstd:streaming
+
+Every output_format/compression combination runs in its own process, so that the reported peak RSS is its own.
+'''
+
+import argparse, collections, datetime, decimal, multiprocessing, os, random, resource, shutil, sqlite3, sys, tempfile, time
+import pyodbc
+from odbc_table_load import ODBCSensor
+
+Column = collections.namedtuple('Column', 'column_name data_type nullable column_size decimal_digits')
+
+# name: (sqlite declared type, pyodbc type, generator)
+column_types = {
+    'integer': ('integer', pyodbc.SQL_INTEGER, lambda r: r.randint(-2**31, 2**31 - 1)),
+    'bigint': ('integer', pyodbc.SQL_BIGINT, lambda r: r.randint(-2**63, 2**63 - 1)),
+    'double': ('real', pyodbc.SQL_DOUBLE, lambda r: r.random() * 1e6),
+    'decimal': ('decimal', pyodbc.SQL_DECIMAL, lambda r: decimal.Decimal(r.randint(0, 10**9)) / 100),
+    'varchar': ('text', pyodbc.SQL_VARCHAR, lambda r: ''.join(r.choice('abcdefghij "') for _ in range(r.randint(0, 30)))),
+    'timestamp': ('timestamp', pyodbc.SQL_TYPE_TIMESTAMP, lambda r: datetime.datetime(2022, 1, 1) + datetime.timedelta(seconds=r.randint(0, 10**8))),
+    'date': ('date', pyodbc.SQL_TYPE_DATE, lambda r: datetime.date(2022, 1, 1) + datetime.timedelta(days=r.randint(0, 1000))),
+    'varbinary': ('blob', pyodbc.SQL_VARBINARY, lambda r: r.randbytes(r.randint(0, 16))),
+}
+
+sqlite3.register_adapter(decimal.Decimal, str)
+sqlite3.register_converter('decimal', lambda b: decimal.Decimal(b.decode()))
+
+class SQLiteCursor(object):
+    ''' The part of the pyodbc cursor interface that the sensor uses. '''
+
+    def __init__(self, connection, columns):
+        self.cursor = connection.cursor()
+        self.column_metadata = columns
+
+    def columns(self, table):
+        return self.column_metadata[table]
+
+    def execute(self, sql, *params):
+        self.cursor.execute(sql, params)
+        return self
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+class SQLiteConnection(object):
+
+    def __init__(self, filename, columns):
+        self.connection = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self.column_metadata = columns
+
+    def cursor(self):
+        return SQLiteCursor(self.connection, self.column_metadata)
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+class BenchmarkSensor(ODBCSensor):
+    ''' Reads from the SQLite file given as ``server`` instead of an ODBC data source. '''
+
+    def connect(self):
+        return SQLiteConnection(self.server, self.config['benchmark_columns'])
+
+def make_table(filename, table, type_names, num_columns, num_rows, null_fraction=0.1, seed=0):
+    r = random.Random(seed)
+    columns = []
+    generators = []
+    for i in range(num_columns):
+        sqlite_type, data_type, generator = column_types[type_names[i % len(type_names)]]
+        columns.append( (Column(f"col_{i}", data_type, True, 18, 2), sqlite_type) )
+        generators.append(generator)
+    connection = sqlite3.connect(filename)
+    connection.execute(f"create table {table} ({', '.join(f'{col.column_name} {sqlite_type}' for col, sqlite_type in columns)})")
+    insert = f"insert into {table} values ({', '.join('?' * num_columns)})"
+    for start in range(0, num_rows, 10000):
+        connection.executemany(insert, [ [ (None if r.random() < null_fraction else g(r)) for g in generators ]
+                                         for _ in range(min(10000, num_rows - start)) ])
+    connection.commit()
+    connection.close()
+    return [ col for col, _ in columns ]
+
+def run_combination(db, table, columns, combination, batch_rows, results):
+    ''' Runs in a child process. Sends (rows/sec, peak RSS in MB, output MB) through ``results``. '''
+    output_format, compression, streaming = combination
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2) # the sensor logs every batch
+    output_folder = tempfile.mkdtemp()
+    config = {
+        'instance_ts_precision': 'D', 'dataset_class': 'benchmark', 'cron_constraint': '0 0 * * *', 'max_instance_age_seconds': 86400,
+        'driver': 'SQLite', 'server': db, 'port': None, 'username': None, 'password': None,
+        'database': 'main', 'table': table, 'benchmark_columns': {table: columns},
+        'batch_rows': batch_rows, 'output_format': output_format, 'compression': compression, 'streaming_upload': streaming,
+        'metrics_file': os.path.join(output_folder, '_metrics.jsonl'),
+    }
+    sensor = BenchmarkSensor(config, {})
+    start = time.time()
+    sensor.save_data_to_path(datetime.datetime(2022, 1, 1), f"file://{output_folder}/data/")
+    seconds = time.time() - start
+    num_rows = sqlite3.connect(db).execute(f"select count(*) from {table}").fetchone()[0]
+    output_bytes = sum( os.path.getsize(os.path.join(output_folder, 'data', f)) for f in os.listdir(os.path.join(output_folder, 'data')) )
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KB on Linux
+    shutil.rmtree(output_folder)
+    results.put( (num_rows / seconds, peak_rss_mb, output_bytes / 1024**2) )
+
+def parse_combination(text):
+    parts = text.split(':')
+    compression = None if parts[1] in ('', 'none', 'null') else parts[1]
+    return (parts[0], compression, len(parts) > 2 and parts[2] == 'streaming')
+
+def main(rows, columns, types, batch_rows, combinations):
+    folder = tempfile.mkdtemp()
+    db = os.path.join(folder, 'source.db')
+    print(f"Generating {rows} rows x {columns} columns of {types}", file=sys.stderr)
+    cols = make_table(db, 'bench', types.split(','), columns, rows)
+
+    context = multiprocessing.get_context('fork')
+    print(f"{'format':8} {'compression':12} {'streaming':10} {'rows/sec':>12} {'peak RSS MB':>12} {'output MB':>10}")
+    for combination in map(parse_combination, combinations.split(',')):
+        results = context.Queue()
+        process = context.Process(target=run_combination, args=(db, 'bench', cols, combination, batch_rows, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            print(f"{combination[0]:8} {str(combination[1]):12} {str(combination[2]):10} failed with exit code {process.exitcode}")
+            continue
+        rows_per_second, peak_rss_mb, output_mb = results.get()
+        print(f"{combination[0]:8} {str(combination[1]):12} {str(combination[2]):10} {rows_per_second:12.0f} {peak_rss_mb:12.1f} {output_mb:10.1f}")
+    shutil.rmtree(folder)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--types", default=','.join(column_types))
+    parser.add_argument("--batch_rows", type=int, default=100000)
+    parser.add_argument("--combinations", default="json:gz,json:none,json:gz:streaming,json:zstd:streaming,parquet:snappy,parquet:zstd,parquet:gz")
+    args = parser.parse_args()
+    main(**args.__dict__)
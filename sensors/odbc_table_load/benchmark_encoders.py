@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+'''
+Micro-benchmark for the JSON row encoding of the ODBC sensor. It compares the former per-cell type dispatch with the encoder compiled by ``DestinationProtocol.compile_json_encoder``, on a wide table with mixed column types::
+
+  python3 benchmark_encoders.py --columns 60 --rows 200000
+
+Both encoders must produce identical output. This is checked before timing.
+'''
+
+import argparse, base64, collections, datetime, io, json, random, time
+import pyodbc
+from odbc_table_load import BigQueryDestination
+
+Column = collections.namedtuple('Column', 'column_name data_type nullable column_size decimal_digits')
+
+column_types = [
+    (pyodbc.SQL_VARCHAR, lambda r: ''.join(r.choice('abcdef "\\é') for _ in range(r.randint(0, 20)))),
+    (pyodbc.SQL_INTEGER, lambda r: r.randint(-2**31, 2**31 - 1)),
+    (pyodbc.SQL_BIGINT, lambda r: r.randint(-2**63, 2**63 - 1)),
+    (pyodbc.SQL_DOUBLE, lambda r: r.random() * 1e6),
+    (pyodbc.SQL_TYPE_TIMESTAMP, lambda r: datetime.datetime(2022, 1, 1) + datetime.timedelta(seconds=r.randint(0, 10**8))),
+    (pyodbc.SQL_TYPE_DATE, lambda r: datetime.date(2022, 1, 1) + datetime.timedelta(days=r.randint(0, 1000))),
+    (pyodbc.SQL_VARBINARY, lambda r: r.randbytes(r.randint(0, 16))),
+    (pyodbc.SQL_BIT, lambda r: r.random() < 0.5),
+]
+
+def make_table(num_columns, num_rows, null_fraction=0.1, seed=0):
+    r = random.Random(seed)
+    columns = []
+    generators = []
+    for i in range(num_columns):
+        data_type, generator = column_types[i % len(column_types)]
+        columns.append(Column(f"col_{i}", data_type, True, 20, 0))
+        generators.append(generator)
+    rows = [ [ (None if r.random() < null_fraction else g(r)) for g in generators ] for _ in range(num_rows) ]
+    return columns, rows
+
+def legacy_write_row_to_file(destination, row, f):
+    ''' The per-cell dispatch that BigQueryDestination.write_row_to_file used before the encoders were compiled. '''
+    for i in range(len(row)):
+        bq_type = destination.type_mapping[destination.sensor.columns[i].data_type]
+        if bq_type in ('DATE','TIME','DATETIME','INTERVAL'):
+            if row[i] is not None:
+                row[i] = str(row[i])
+        elif bq_type == 'BYTES':
+            if row[i] is not None:
+                row[i] = base64.b64encode(row[i]).decode('utf-8')
+    json.dump(dict(filter((lambda x: x[1] is not None), zip(destination.col_names, row))), f)
+    f.write('\n')
+
+def main(columns, rows, fetch_rows):
+    cols, data = make_table(columns, rows)
+    sensor = argparse.Namespace(columns=cols, output_format='json')
+    destination = BigQueryDestination('bq://project/dataset/table', sensor)
+    destination.col_names = [ col.column_name for col in cols ]
+    encode_rows = destination.compile_json_encoder()
+
+    chunks = [ data[i:i+fetch_rows] for i in range(0, len(data), fetch_rows) ]
+
+    start = time.time()
+    f = io.StringIO()
+    for chunk in chunks:
+        f.write(encode_rows(chunk))
+    compiled_seconds = time.time() - start
+    compiled_output = f.getvalue()
+
+    start = time.time()
+    f = io.StringIO()
+    for chunk in chunks:
+        for row in chunk:
+            legacy_write_row_to_file(destination, list(row), f)
+    legacy_seconds = time.time() - start
+
+    assert f.getvalue() == compiled_output, "compiled encoder output differs from the legacy output"
+    print(f"{columns} columns x {rows} rows")
+    print(f"legacy per-cell dispatch: {rows / legacy_seconds:12.0f} rows/sec")
+    print(f"compiled encoder:         {rows / compiled_seconds:12.0f} rows/sec ({legacy_seconds / compiled_seconds:.2f}x)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--columns", type=int, default=60)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--fetch_rows", type=int, default=5000)
+    args = parser.parse_args()
+    main(**args.__dict__)
@@ -41,6 +41,43 @@ The behavior is as follows:
  * custom_sql
  * repository
  * credentials.requested_name
+ * output_format (``json`` or ``parquet``)
+ * compression
+
+5. Optionally, the data can be extracted over several concurrent connections by splitting the query on a key column. Each slice writes its own part files.
+
+ * partition_column
+ * partition_count
+ * partition_method
+
+6. Fetching, serializing and uploading run concurrently. Rows are handed over in chunks of ``fetch_rows``, so memory is capped at roughly ``fetch_rows`` times (``pipeline_queue_size`` + number of slices + 2 * ``upload_threads``) rows, whatever ``batch_rows`` is. Parquet also keeps the Arrow columns of each batch being written.
+
+ * batch_rows
+ * fetch_rows
+ * upload_threads
+ * pipeline_queue_size
+ * streaming_upload, part_size_bytes and multipart_chunk_bytes (S3 and Google Storage)
+ * composite_threshold_bytes and composite_upload_threads (Google Storage only)
+
+7. Optionally, only the rows added since the previous instance are loaded. Instances are then loaded oldest first, and each one gets the rows of ``incremental_column`` above the high mark of the instance before it. The (low, high] range is stored with the dataset (``_WATERMARKS`` in object stores, the table description in BigQuery) and the previous mark is read back from the datasets in the catalog, so the sensor can move hosts. ``watermark_file`` only caches the marks locally. Reloading an instance reuses its recorded range, so a backfill can restart from any recorded mark by removing the later datasets.
+
+ * incremental_column
+ * incremental_start
+ * watermark_file
+
+Connections are pooled across datasets (``pool_max_idle``, ``pool_idle_seconds``) and the column metadata is cached for ``schema_cache_seconds`` unless the table changes.
+
+For Google Storage, parts of at least ``composite_threshold_bytes``, as well as streamed parts, are uploaded as components of ``multipart_chunk_bytes`` over ``composite_upload_threads`` parallel requests and then composed into the part file, so a single upload stream does not limit the load.
+
+For BigQuery, setting ``bq_staging_uri`` to a Google Storage prefix stages all the batches there. They are loaded with a single load job into a temporary table, which then replaces the destination table in one step. Readers never see a half loaded table.
+
+If ``checkpoint_column`` is set to a unique key, the rows are read in key order and every uploaded batch is recorded in a file in ``checkpoint_dir``. When the sensor dies halfway, the next attempt at the same uri continues after the last uploaded batch instead of starting over. For BigQuery this needs ``bq_staging_uri``.
+
+Per batch and per load, the time spent fetching, encoding, compressing and uploading, along with rows/sec, bytes/sec and queue depths, is written as JSON lines to ``metrics_file`` (stderr by default) and optionally to a Prometheus ``prometheus_textfile``.
+
+Instead of a single ``table``, a list of ``tables`` can be given, each with its own ``cron_constraint``, ``custom_sql`` and, optionally, any other table level setting above. They are all served by one sensor process with a shared connection pool, and their missing instances are interleaved round robin. The catalog is queried for the one ``dataset_class`` of the sensor, so the entries share it and are told apart by ``instance_prefix``, which defaults to the table.
+
+To catch up faster after an outage, ``concurrency`` copies of the sensor loop run in separate processes. Each one materializes the newest missing instance no other copy has claimed. The copies are restarted if they die, and the instances they had claimed go to the others. ``max_source_connections`` caps the connections open across all of them, idle pooled ones included.
 
 .. admonition:: Warning
     :class: warning
@@ -55,21 +92,40 @@ Supported repository classes as destination:
 
 1. ``s3``
 2. ``bigquery``
+3. ``gs``
+4. ``file`` (local folder, for testing)
 
 
 '''
 
 
 import argparse, os, sys
-import treldev, pyodbc, tempfile, json, datetime, subprocess
+import treldev, pyodbc, tempfile, json, datetime, decimal, subprocess, queue, threading, base64, zlib, time, contextlib, multiprocessing, uuid, gzip, shutil, copy, hashlib, collections, concurrent.futures
 from os import listdir
 from os.path import isfile, join, isdir
 
+backfill_worker_index = 0 # set in the processes started by ODBCSensor.start_backfill_workers
+source_connections = None # semaphore shared by all the processes of this sensor
+backfill_claims = None # {str(load_info): (worker_index, expiry)} of the instances being materialized, shared by all the processes
+backfill_claims_lock = None
+
 class ODBCSensor(treldev.Sensor):
 
 
     
     def __init__(self, config, credentials, *args, **kwargs):
+        if 'tables' in config:
+            # the catalog query of the sensor covers its one dataset_class, with every instance_prefix, so the tables are told apart by instance_prefix
+            if not config.get('dataset_class'):
+                raise Exception("tables needs the dataset_class of the sensor")
+            prefixes = set()
+            for table_config in config['tables']:
+                if table_config.get('dataset_class', config['dataset_class']) != config['dataset_class']:
+                    raise Exception(f"Every entry of tables has to use the dataset_class of the sensor, {config.get('dataset_class')}. {table_config.get('table')} uses {table_config.get('dataset_class')}")
+                prefix = table_config.get('instance_prefix') or table_config['table']
+                if prefix in prefixes:
+                    raise Exception(f"Every entry of tables needs its own instance_prefix, which defaults to the table. {prefix} is used more than once")
+                prefixes.add(prefix)
         super().__init__(config, credentials, *args, **kwargs)
         
         self.instance_ts_precision = self.config['instance_ts_precision']
@@ -87,65 +143,835 @@ class ODBCSensor(treldev.Sensor):
             self.password = self.config['password']
             
         self.database = self.config['database']
+        self.known_contents = set([])
+        self.lookback_seconds = self.config['max_instance_age_seconds'] - 1 # how far we should backfill missing datasets
+        self.locking_seconds = self.config.get('locking_seconds',600)
+        self.upload_threads = self.config.get('upload_threads',4)
+        self.pipeline_queue_size = self.config.get('pipeline_queue_size',2)
+        self.concurrency = self.config.get('concurrency',1)
+        self.worker_index = backfill_worker_index
+        if self.worker_index == 0 and self.concurrency > 1:
+            self.start_backfill_workers()
+        semaphore = source_connections
+        if semaphore is None and self.config.get('max_source_connections') is not None:
+            semaphore = threading.BoundedSemaphore(self.config['max_source_connections']) # a single process has no one to share it with
+        # by default, no more connections are kept than one load uses, one per slice
+        max_slices = max( (table_config.get('partition_count', self.config.get('partition_count',4))
+                           if table_config.get('partition_column', self.config.get('partition_column')) is not None else 1)
+                          for table_config in self.config.get('tables', [{}]) )
+        max_idle = self.config.get('pool_max_idle')
+        self.pool = ConnectionPool(self.connect,
+                                   max_idle=max_slices if max_idle is None else max_idle,
+                                   idle_seconds=self.config.get('pool_idle_seconds',300),
+                                   semaphore=semaphore)
+        self.schema_cache_seconds = self.config.get('schema_cache_seconds',3600)
+
+        self.tables = {}
+        if 'tables' in self.config:
+            for table_config in self.config['tables']:
+                view = copy.copy(self)
+                view.tables = {}
+                view.config = dict(self.config, **dict(table_config, instance_prefix=table_config.get('instance_prefix') or table_config['table']))
+                view.configure_table()
+                self.tables[view.instance_prefix] = view
+        else:
+            self.configure_table()
+
+    def configure_table(self):
+        ''' Reads the settings that can be given per entry of ``tables``. '''
+        self.dataset_class = self.config.get('dataset_class')
+        self.instance_prefix = self.config.get('instance_prefix')
         self.table = self.config['table']
         self.custom_sql = self.config.get('custom_sql')
         self.batch_rows = self.config.get('batch_rows',100000)
+        self.fetch_rows = min(self.config.get('fetch_rows',1000), self.batch_rows)
         self.output_format = self.config.get('output_format','json')
         self.compression = self.config.get('compression','gz')
-        self.known_contents = set([])
         self.cron_constraint = self.config['cron_constraint']
-        self.lookback_seconds = self.config['max_instance_age_seconds'] - 1 # how far we should backfill missing datasets
-        self.locking_seconds = self.config.get('locking_seconds',600)
+        self.partition_column = self.config.get('partition_column')
+        self.partition_count = self.config.get('partition_count',4)
+        self.partition_method = self.config.get('partition_method','range')
+        assert self.partition_method in ('range','mod')
+        self.streaming_upload = self.config.get('streaming_upload',False)
+        self.part_size_bytes = self.config.get('part_size_bytes',1024**3)
+        self.multipart_chunk_bytes = self.config.get('multipart_chunk_bytes',16*1024**2)
+        self.composite_threshold_bytes = self.config.get('composite_threshold_bytes',150*1024**2)
+        self.composite_upload_threads = self.config.get('composite_upload_threads',8)
+        self.incremental_column = self.config.get('incremental_column')
+        self.incremental_start = self.config.get('incremental_start')
+        self.watermark_file = os.path.expanduser(self.config.get('watermark_file') or f"~/odbc_watermarks.{self.database}.{self.instance_prefix if 'tables' in self.config else self.table}.json")
+        self.recorded_datasets = {} # instance_ts: uri of the datasets in the catalog, for the incremental marks stored with them
+        assert self.concurrency == 1 or self.incremental_column is None, "incremental loads have to run in order, so concurrency must be 1"
+        self.schema_cache = None # (columns, fingerprint, loaded_at)
+        self.bq_staging_uri = self.config.get('bq_staging_uri')
+        self.checkpoint_column = self.config.get('checkpoint_column')
+        self.checkpoint_dir = os.path.expanduser(self.config.get('checkpoint_dir','~/odbc_checkpoints'))
+        self.metrics_file = self.config.get('metrics_file')
+        self.prometheus_textfile = self.config.get('prometheus_textfile')
     
     def get_new_datasetspecs(self, datasets, **kwargs):
         # res = list( self.get_new_datasetspecs_with_cron_and_precision(datasets) )
         # self.logger.debug(res)
         # return res
+        specs = self.get_all_tables_datasetspecs(datasets) if self.tables else self.get_table_datasetspecs(datasets)
+        if self.concurrency > 1:
+            return self.claim_datasetspecs(specs)
+        return specs
+
+    def claim_datasetspecs(self, specs):
+        ''' Yields the instances no other process of this sensor is materializing, still newest first. Each one is claimed until its ``save_data_to_path`` ends, or for ``locking_seconds`` if that is never called. '''
+        for load_info, spec in specs:
+            key = str(load_info)
+            with backfill_claims_lock:
+                claim = backfill_claims.get(key)
+                if claim is not None and claim[0] != self.worker_index and claim[1] > time.time():
+                    continue
+                backfill_claims[key] = (self.worker_index, time.time() + self.locking_seconds)
+            yield load_info, spec
+
+    def release_claim(self, load_info):
+        if backfill_claims is not None:
+            with backfill_claims_lock:
+                backfill_claims.pop(str(load_info), None)
+
+    def get_table_datasetspecs(self, datasets):
+        if self.incremental_column is not None:
+            self.recorded_datasets = { str(ds['instance_ts'])[:19].replace('T', ' '): ds['uri'] for ds in datasets if ds.get('uri') }
+            # each instance continues from the mark of the one before it
+            return sorted(self.get_new_datasetspecs_with_cron_and_precision(datasets), key=lambda x: x[0])
         return self.get_new_datasetspecs_with_cron_and_precision(datasets)
+
+    def get_all_tables_datasetspecs(self, datasets):
+        ''' Interleaves the missing instances of all the ``tables`` round robin, so that a table with a long backlog does not hold up the others. '''
+        pending = [ self.get_tagged_datasetspecs(view, datasets) for view in self.tables.values() ]
+        while pending:
+            for specs in list(pending):
+                try:
+                    yield next(specs)
+                except StopIteration:
+                    pending.remove(specs)
+
+    @staticmethod
+    def get_tagged_datasetspecs(view, datasets):
+        table_datasets = [ ds for ds in datasets if ds.get('instance_prefix') == view.instance_prefix ]
+        for load_info, spec in view.get_table_datasetspecs(table_datasets):
+            yield (view.instance_prefix, load_info), dict(spec, instance_prefix=view.instance_prefix)
+
+    def start_backfill_workers(self):
+        ''' Starts ``concurrency - 1`` more copies of this sensor, so that up to ``concurrency`` instances are materialized at once. Every copy runs the regular sensor loop, so each instance still gets its own catalog lock and destination. ``max_source_connections``, if set, caps the connections open across all of them.
+
+        The copies come from a fork server, so they do not inherit the clients of this process. A thread restarts any copy that dies, after dropping its claims so that the other copies take over its instances. '''
+        global source_connections, backfill_claims, backfill_claims_lock
+        context = multiprocessing.get_context('forkserver')
+        max_source_connections = self.config.get('max_source_connections')
+        if max_source_connections is not None:
+            source_connections = context.BoundedSemaphore(max_source_connections)
+        manager = context.Manager()
+        backfill_claims = manager.dict()
+        backfill_claims_lock = manager.Lock()
+        def start(worker_index):
+            process = context.Process(target=run_backfill_worker, args=(worker_index, source_connections, backfill_claims, backfill_claims_lock), daemon=True)
+            process.start()
+            return process
+        workers = { worker_index: start(worker_index) for worker_index in range(1, self.concurrency) }
+        def supervise():
+            while True:
+                time.sleep(10)
+                for worker_index, process in list(workers.items()):
+                    if process.is_alive():
+                        continue
+                    self.logger.error(f"Backfill worker {worker_index} exited with code {process.exitcode}. Restarting it.")
+                    with backfill_claims_lock:
+                        for key, claim in list(backfill_claims.items()):
+                            if claim[0] == worker_index:
+                                del backfill_claims[key]
+                    workers[worker_index] = start(worker_index)
+        threading.Thread(target=supervise, daemon=True).start()
+    
+    def connect(self):
+        return pyodbc.connect('DRIVER={'+self.driver+'};SERVER='+self.server+';DATABASE='+self.database+';UID='+self.username+';PWD='+ self.password)
+
+    def get_columns(self, cursor):
+        ''' Returns the column metadata of the table. The catalog is only queried if the cached copy is older than ``schema_cache_seconds`` or the fingerprint of the table, taken from an empty result set, has changed. '''
+        cursor.execute(f"select * from `{self.table}` where 1 = 0")
+        fingerprint = [ tuple(map(str, d)) for d in cursor.description ]
+        cursor.fetchall()
+        if self.schema_cache is not None:
+            columns, cached_fingerprint, loaded_at = self.schema_cache
+            if cached_fingerprint == fingerprint and time.time() - loaded_at < self.schema_cache_seconds:
+                return columns, True
+        columns = list(cursor.columns(table=self.table))
+        self.schema_cache = (columns, fingerprint, time.time())
+        return columns, False
+
+    def get_sql(self, minute):
+        return ("select * from `{table}`"
+                if self.custom_sql is None
+                else self.custom_sql).format(
+                        table=self.table,
+                        instance_ts=minute,
+                        instance_ts_precision=self.instance_ts_precision)
+
+    def load_watermarks(self):
+        ''' Returns the recorded {instance_ts: [low, high]} marks of the incremental mode. '''
+        if not os.path.exists(self.watermark_file):
+            return {}
+        with open(self.watermark_file) as f:
+            return json.load(f)
+
+    def save_watermarks(self, watermarks):
+        with open(self.watermark_file + '.tmp', 'w') as f:
+            json.dump(watermarks, f, indent=1, sort_keys=True)
+        os.replace(self.watermark_file + '.tmp', self.watermark_file)
+
+    def record_watermarks(self, minute, low, high, uri):
+        watermarks = self.load_watermarks()
+        watermarks[str(minute)] = [ encode_watermark(low), encode_watermark(high) ]
+        self.save_watermarks(watermarks)
+        self.recorded_datasets[str(minute)] = uri
+
+    def find_watermarks(self, watermarks, keys):
+        ''' Returns the first of the recorded instances ``keys`` that has marks. Marks missing from ``watermarks``, the local cache, are read from the dataset and added to it. '''
+        for key in keys:
+            if key not in watermarks:
+                marks = DestinationProtocol.get_object_from_uri(self.recorded_datasets[key], self).read_watermarks()
+                if marks is None:
+                    continue
+                watermarks[key] = marks
+                self.save_watermarks(watermarks)
+            return key
+        return None
+
+    def get_incremental_sql(self, cursor, sql, minute):
+        ''' Restricts ``sql`` to the rows of ``incremental_column`` above the high mark of the closest earlier instance in the catalog, up to the current maximum. An instance that was loaded before gets exactly the same range again, and an instance loaded out of order stops at the low mark of the next one in the catalog. Returns (sql, params, low, high). '''
+        col = f"`{self.incremental_column}`"
+        watermarks = self.load_watermarks()
+        key = str(minute)
+        if key in watermarks:
+            low, high = [ decode_watermark(v) for v in watermarks[key] ]
+        else:
+            earlier = self.find_watermarks(watermarks, sorted((k for k in self.recorded_datasets if k < key), reverse=True))
+            later = self.find_watermarks(watermarks, sorted(k for k in self.recorded_datasets if k > key))
+            low = decode_watermark(watermarks[earlier][1]) if earlier else self.incremental_start
+            if later:
+                high = decode_watermark(watermarks[later][0])
+            else:
+                cursor.execute(f"select max({col}) from ({sql}) as t")
+                high = cursor.fetchone()[0]
+        conditions, params = [], []
+        if low is not None:
+            conditions.append(f"{col} > ?")
+            params.append(low)
+        if high is not None:
+            conditions.append(f"{col} <= ?")
+            params.append(high)
+        else: # nothing to load, either the table is empty or a later instance already has it all
+            conditions.append("1 = 0")
+            high = low
+        print(f"Incremental load of {self.incremental_column} in ({low}, {high}]", file=sys.stderr)
+        return f"select * from ({sql}) as t where " + " and ".join(conditions), params, low, high
+
+    def get_partition_sqls(self, cursor, sql, params):
+        ''' Splits ``sql`` into ``partition_count`` slices on ``partition_column``. Returns a list of (sql, params) tuples that together cover every row of ``sql``, including those with a NULL key. '''
+        col = f"`{self.partition_column}`"
+        if self.partition_method == 'mod':
+            # mod of a negative key is negative in MySQL and MariaDB, so it is shifted into 0..partition_count-1
+            n = self.partition_count
+            return [ (f"select * from ({sql}) as t where (mod(mod({col}, {n}) + {n}, {n}) = {i}"
+                      + (f" or {col} is null)" if i == 0 else ")"), params)
+                     for i in range(n) ]
+        
+        cursor.execute(f"select min({col}), max({col}) from ({sql}) as t", *params)
+        lo, hi = cursor.fetchone()
+        if lo is None or lo == hi:
+            return [ (sql, params) ]
+        boundaries = []
+        is_date = isinstance(lo, datetime.date) and not isinstance(lo, datetime.datetime)
+        for i in range(1, self.partition_count):
+            if isinstance(lo, int) or is_date:
+                # split the distinct values, so that narrow ranges such as (0, 1) still split
+                first, last = (lo.toordinal(), hi.toordinal()) if is_date else (lo, hi)
+                boundary = first + (last - first + 1) * i // self.partition_count
+                if is_date:
+                    boundary = datetime.date.fromordinal(boundary)
+            else: # float, Decimal and datetime ranges
+                boundary = lo + (hi - lo) * i / self.partition_count
+            if lo < boundary <= hi and (not boundaries or boundary > boundaries[-1]):
+                boundaries.append(boundary)
+        if not boundaries:
+            return [ (sql, params) ]
+        # the outer slices are left open so that no row is missed
+        res = [ (f"select * from ({sql}) as t where ({col} < ? or {col} is null)", params + [boundaries[0]]) ]
+        for b0, b1 in zip(boundaries, boundaries[1:]):
+            res.append( (f"select * from ({sql}) as t where {col} >= ? and {col} < ?", params + [b0, b1]) )
+        res.append( (f"select * from ({sql}) as t where {col} >= ?", params + [boundaries[-1]]) )
+        return res
     
     def save_data_to_path(self, load_info, uri, dataset=None, **kwargs):
         ''' if the previous call to get_new_datasetspecs returned a (load_info, datasetspec) tuple, then this call should save the data to the provided path, given the corresponding (load_info, path). '''
-        minute = load_info
+        try:
+            if self.tables:
+                instance_prefix, minute = load_info
+                self.tables[instance_prefix].load_table(minute, uri)
+            else:
+                self.load_table(load_info, uri)
+        finally:
+            self.release_claim(load_info)
 
-        cnxn = pyodbc.connect('DRIVER={'+self.driver+'};SERVER='+self.server+';DATABASE='+self.database+';UID='+self.username+';PWD='+ self.password)
-        cursor = cnxn.cursor()
+    def load_table(self, minute, uri):
+        checkpoint = None
+        if self.checkpoint_column is not None:
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+            checkpoint = Checkpoint(os.path.join(self.checkpoint_dir, hashlib.sha1(uri.encode()).hexdigest() + '.json'))
+        with self.pool.connection() as cnxn:
+            cursor = cnxn.cursor()
+            destination, slices, watermarks = self.plan_extraction(cursor, minute, uri, checkpoint)
+            if len(slices) == 1:
+                self.run_pipeline(slices, destination, cursor, checkpoint)
+        if len(slices) > 1:
+            # each slice takes its own connection, so the one used for planning is given back first
+            self.run_pipeline(slices, destination, None, checkpoint)
+        if watermarks is not None:
+            destination.record_watermarks(*watermarks)
+        destination.finish()
+        if watermarks is not None:
+            self.record_watermarks(minute, *watermarks, uri)
+        if checkpoint is not None:
+            checkpoint.clear()
+        print(f"Connections: {self.pool.stats['created']} created in {self.pool.stats['connect_seconds']:.2f} seconds, {self.pool.stats['reused']} reused", file=sys.stderr)
 
-        self.columns = list(cursor.columns(table=self.table))
+    def plan_extraction(self, cursor, minute, uri, checkpoint=None):
+        ''' Looks up the schema, prepares the destination and works out the queries. Returns (destination, slices, watermarks), where slices is a list of (sql, params) and watermarks is the incremental (low, high) range or None. When resuming from a ``checkpoint``, the plan of the interrupted attempt is reused. '''
+        start = time.time()
+        self.columns, cached = self.get_columns(cursor)
+        print(f"Schema lookup took {time.time() - start:.2f} seconds{' (cached)' if cached else ''}", file=sys.stderr)
         
         print(f"Table {uri} columns: ",file=sys.stderr)
         for col in self.columns:
             print(f"  {col}", file=sys.stderr)
         
         destination = DestinationProtocol.get_object_from_uri(uri, self)
+        if checkpoint is not None and checkpoint.state is not None:
+            print(f"Resuming {uri} from checkpoint {checkpoint.filename}", file=sys.stderr)
+            destination.prepare(checkpoint.state['destination'])
+            plan = checkpoint.state['plan']
+            slices = [ (sql, [ decode_watermark(p) for p in params ]) for sql, params in plan['slices'] ]
+            watermarks = None if plan['watermarks'] is None else tuple(decode_watermark(w) for w in plan['watermarks'])
+            return destination, slices, watermarks
         destination.prepare()
             
-        fetch_rows = self.batch_rows // 20
-        sql = ("select * from `{table}`"
-               if self.custom_sql is None
-               else self.custom_sql).format(
-                       table=self.table,
-                       instance_ts=minute,
-                       instance_ts_precision=self.instance_ts_precision)
-        print(f"Executing:\n{sql}", file=sys.stderr)
-        cursor.execute(sql)
+        sql, params, watermarks = self.get_sql(minute), [], None
+        if self.incremental_column is not None:
+            sql, params, low, high = self.get_incremental_sql(cursor, sql, minute)
+            watermarks = (low, high)
+        if self.partition_column is None:
+            slices = [ (sql, params) ]
+        else:
+            slices = self.get_partition_sqls(cursor, sql, params)
+            print(f"Extracting {len(slices)} slices on {self.partition_column} using {self.partition_method}", file=sys.stderr)
+        if checkpoint is not None:
+            checkpoint.start({'slices': [ (sql, [ encode_watermark(p) for p in params ]) for sql, params in slices ],
+                              'watermarks': None if watermarks is None else [ encode_watermark(w) for w in watermarks ]},
+                             destination.get_resume_state())
+        return destination, slices, watermarks
+
+    def run_pipeline(self, slices, destination, cursor, checkpoint=None):
+        ''' Fetches each slice on its own producer thread and hands the batches to ``upload_threads`` workers that serialize and upload them. The queue between them holds at most ``pipeline_queue_size`` batches. Each batch is a queue of its own, through which the ``fetchmany`` results are passed one at a time while the worker serializes them, so rows in memory are bounded by ``fetch_rows`` rather than ``batch_rows``.
+
+        Part numbers are assigned by the producers, so they do not depend on which worker finishes first. Any failure stops all threads and is re-raised here, before ``_SUCCESS`` can be written. Every uploaded batch is recorded in the ``checkpoint``, if given. '''
+        batches = queue.Queue(maxsize=self.pipeline_queue_size)
+        failed = threading.Event()
+        errors = []
+        metrics = LoadMetrics(self.table, destination.uri, self.metrics_file,
+                              self.prometheus_textfile and self.prometheus_textfile.format(table=self.table))
+        def guard(fn, *args):
+            try:
+                fn(*args)
+            except BaseException as ex:
+                errors.append(ex)
+                failed.set()
+        
+        producers = [ threading.Thread(target=guard, args=(self.produce_batches, cursor, destination, slice_sql, params, slice_i, len(slices), batches, failed, checkpoint, metrics))
+                      for slice_i, (slice_sql, params) in enumerate(slices) ]
+        workers = [ threading.Thread(target=guard, args=(self.upload_batches, destination, batches, failed, checkpoint, metrics))
+                    for _ in range(self.upload_threads) ]
+        for t in producers + workers:
+            t.start()
+        for t in producers:
+            t.join()
+        for _ in workers:
+            self.put_batch(batches, None, failed)
+        for t in workers:
+            t.join()
+        metrics.finish(failed=bool(errors))
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def put_batch(batches, item, failed):
+        ''' Blocks until there is room in the queue. Returns False if the pipeline failed in the meantime. '''
+        while not failed.is_set():
+            try:
+                batches.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def get_batch(batches, failed):
+        ''' Blocks until there is an item in the queue. Raises if the pipeline failed in the meantime. '''
+        while not failed.is_set():
+            try:
+                return batches.get(timeout=1)
+            except queue.Empty:
+                pass
+        raise Exception("Aborting as the pipeline failed")
+    
+    def produce_batches(self, cursor, destination, sql, params, slice_i, num_slices, batches, failed, checkpoint=None, metrics=None):
+        ''' Runs ``sql`` and queues its rows in batches of ``batch_rows``. Each batch is queued as soon as it starts, as a queue of its ``fetchmany`` results ending with a ``BatchEnd``. Batch k of this slice becomes part k * num_slices + slice_i, so slices never collide. A connection is taken from the pool if ``cursor`` is None.
+
+        With a ``checkpoint``, rows are read in ``checkpoint_column`` order, which makes the batches repeatable. A resumed slice starts after the key of its last batch that was uploaded along with all the ones before it, and batches that were already uploaded after that are not uploaded again. '''
+        if cursor is None:
+            with self.pool.connection() as cnxn:
+                return self.produce_batches(cnxn.cursor(), destination, sql, params, slice_i, num_slices, batches, failed, checkpoint, metrics)
+        batch_i, uploaded = 0, set()
+        if checkpoint is not None:
+            batch_i, key, uploaded = checkpoint.get_resume_point(slice_i)
+            col = f"`{self.checkpoint_column}`"
+            if key is not None:
+                sql, params = f"select * from ({sql}) as t where {col} > ? order by {col}", params + [key]
+            else:
+                sql = f"select * from ({sql}) as t order by {col}"
+        print(f"Executing:\n{sql}\nwith {params}", file=sys.stderr)
+        cursor.execute(sql, *params)
+        destination.describe(cursor.description)
+        if checkpoint is not None:
+            key_index = [ d[0] for d in cursor.description ].index(self.checkpoint_column)
         done = False
         while not done:
-            with tempfile.NamedTemporaryFile('w+', delete=False) as f:
-                for batch_i in range(20):
+            if failed.is_set():
+                raise Exception("Aborting extraction as the pipeline failed")
+            start = time.time()
+            fetched = cursor.fetchmany(self.fetch_rows)
+            fetch_seconds = time.time() - start
+            if not fetched and batch_i > 0:
+                break
+            chunks = None # batches that were already uploaded are read past, but not queued
+            if batch_i not in uploaded:
+                chunks = queue.Queue(maxsize=1)
+                if not self.put_batch(batches, (batch_i * num_slices + slice_i, chunks), failed):
+                    raise Exception("Aborting extraction as the pipeline failed")
+            num_rows, last_key = 0, None
+            while True:
+                if not fetched:
                     done = True
-                    for row in cursor.fetchmany(fetch_rows):
-                        done = False
-                        destination.write_row_to_file(row, f)
-                    if done:
-                        break
-            print(f"Uploading batch {destination.get_next_batch_num()} data from {f.name} to {uri}",file=sys.stderr)
-            destination.append_data(f.name)
+                    break
+                num_rows += len(fetched)
+                if checkpoint is not None:
+                    last_key = fetched[-1][key_index]
+                if chunks is not None and not self.put_batch(chunks, fetched, failed):
+                    raise Exception("Aborting extraction as the pipeline failed")
+                if num_rows >= self.batch_rows:
+                    break
+                start = time.time()
+                fetched = cursor.fetchmany(min(self.fetch_rows, self.batch_rows - num_rows))
+                fetch_seconds += time.time() - start
+            if chunks is not None:
+                progress = None if checkpoint is None else (slice_i, batch_i, last_key)
+                if not self.put_batch(chunks, BatchEnd(progress, {'rows': num_rows, 'fetch_seconds': fetch_seconds}), failed):
+                    raise Exception("Aborting extraction as the pipeline failed")
+            batch_i += 1
+
+    def upload_batches(self, destination, batches, failed, checkpoint=None, metrics=None):
+        while not failed.is_set():
+            try:
+                item = batches.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            batch_num, chunks = item
+            queue_depth = batches.qsize()
+            end = []
+            def rows():
+                while True:
+                    chunk = self.get_batch(chunks, failed)
+                    if isinstance(chunk, BatchEnd):
+                        end.append(chunk)
+                        return
+                    yield chunk
+            upload_stats = destination.upload_batch(rows(), batch_num)
+            progress, stats = end[0]
+            stats.update(upload_stats)
+            if checkpoint is not None:
+                checkpoint.record_batch(*progress)
+            if metrics is not None:
+                metrics.record_batch(batch_num, stats, queue_depth)
             sys.stderr.flush()
-        destination.finish()
+
+BatchEnd = collections.namedtuple('BatchEnd', 'progress stats') # the last item of a batch, after its fetchmany results
+
+def run_backfill_worker(worker_index, semaphore, claims, claims_lock):
+    global backfill_worker_index, source_connections, backfill_claims, backfill_claims_lock
+    backfill_worker_index = worker_index
+    source_connections, backfill_claims, backfill_claims_lock = semaphore, claims, claims_lock
+    treldev.Sensor.init_and_run(ODBCSensor)
+
+class LoadMetrics(object):
+    ''' Per stage throughput of one load. Each batch, and a summary at the end, is written as a JSON line to ``metrics_file``, or to stderr if that is not set. The summary can also be written to a Prometheus ``textfile``.
+
+    The stages are fetch (``cursor.fetchmany``), encode, compress and upload. Their seconds are summed over all threads, so they show where the time goes, not the wall clock time. '''
+
+    stages = ['fetch', 'encode', 'compress', 'upload']
+
+    def __init__(self, table, uri, metrics_file=None, textfile=None):
+        self.table = table
+        self.uri = uri
+        self.metrics_file = metrics_file
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.totals = collections.Counter(rows=0, bytes=0, batches=0) # so a load that fails before its first batch still reports them
+        self.max_queue_depth = 0
+        self.start = time.time()
+
+    def emit(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            if self.metrics_file is None:
+                print(line, file=sys.stderr)
+            else:
+                with open(self.metrics_file, 'a') as f:
+                    f.write(line + '\n')
+
+    def record_batch(self, batch_num, stats, queue_depth):
+        with self.lock:
+            self.totals.update(stats)
+            self.totals['batches'] += 1
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        record = {'event': 'batch', 'table': self.table, 'uri': self.uri, 'batch': batch_num, 'queue_depth': queue_depth}
+        record.update(stats)
+        busy_seconds = sum( stats.get(f'{stage}_seconds', 0) for stage in self.stages )
+        if busy_seconds > 0:
+            record['rows_per_second'] = stats['rows'] / busy_seconds
+        self.emit(record)
+
+    def finish(self, failed=False):
+        elapsed = time.time() - self.start
+        record = {'event': 'summary', 'table': self.table, 'uri': self.uri, 'failed': failed, 'seconds': elapsed,
+                  'max_queue_depth': self.max_queue_depth,
+                  'rows_per_second': self.totals['rows'] / elapsed if elapsed else 0,
+                  'bytes_per_second': self.totals['bytes'] / elapsed if elapsed else 0}
+        record.update(self.totals)
+        self.emit(record)
+        if self.textfile is not None:
+            self.write_textfile(record)
+
+    def write_textfile(self, record):
+        labels = f'table="{self.table}"'
+        lines = [ f'odbc_load_{name}{{{labels}}} {record[name]}' for name in ['rows', 'bytes', 'batches', 'seconds', 'max_queue_depth', 'rows_per_second', 'bytes_per_second'] ]
+        lines += [ f'odbc_load_stage_seconds{{{labels},stage="{stage}"}} {record.get(stage + "_seconds", 0)}' for stage in self.stages ]
+        lines.append( f'odbc_load_failed{{{labels}}} {int(record["failed"])}' )
+        lines.append( f'odbc_load_finished_timestamp_seconds{{{labels}}} {time.time()}' )
+        with open(self.textfile + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.textfile + '.tmp', self.textfile)
+
+class Checkpoint(object):
+    ''' Progress of the extraction into one uri, kept in a local file. It holds the plan (the slice queries and the incremental range), the state of the destination and, per slice, the last key of every uploaded batch. '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.state = None
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.state = json.load(f)
+
+    def start(self, plan, destination_state):
+        self.state = {'plan': plan, 'destination': destination_state, 'slices': {}}
+        self.save()
+
+    def save(self):
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def record_batch(self, slice_i, batch_i, last_key):
+        with self.lock:
+            self.state['slices'].setdefault(str(slice_i), {})[str(batch_i)] = encode_watermark(last_key)
+            self.save()
+
+    def get_resume_point(self, slice_i):
+        ''' Returns (first batch to extract, key to continue after, batches already uploaded). '''
+        with self.lock:
+            uploaded = { int(k): decode_watermark(v) for k, v in self.state['slices'].get(str(slice_i), {}).items() }
+        first_batch = 0
+        while first_batch in uploaded:
+            first_batch += 1
+        key = uploaded[first_batch - 1] if first_batch > 0 else None
+        return first_batch, key, set(uploaded)
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+class ConnectionPool(object):
+    ''' Keeps idle ODBC connections for reuse across datasets. A connection is health checked before it is handed out again and is closed once it has been idle for ``idle_seconds``, checked on every release and by a timer while any are idle. If a ``semaphore`` is given, it is held for every open connection, idle or in use, so idle ones count against the cap too. '''
+
+    def __init__(self, connect, max_idle=8, idle_seconds=300, health_check_sql="select 1", semaphore=None):
+        self.connect = connect
+        self.semaphore = semaphore
+        self.max_idle = max_idle
+        self.idle_seconds = idle_seconds
+        self.health_check_sql = health_check_sql
+        self.idle = [] # (connection, released_at)
+        self.lock = threading.Lock()
+        self.timer = None
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0, 'unhealthy': 0, 'connect_seconds': 0.0}
+
+    def close(self, cnxn):
+        try:
+            cnxn.close()
+        except pyodbc.Error:
+            pass
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    def is_healthy(self, cnxn):
+        try:
+            cursor = cnxn.cursor()
+            cursor.execute(self.health_check_sql).fetchall()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def evict_idle(self):
+        now = time.time()
+        with self.lock:
+            expired = [ cnxn for cnxn, released_at in self.idle if now - released_at > self.idle_seconds ]
+            self.idle = [ (cnxn, released_at) for cnxn, released_at in self.idle if now - released_at <= self.idle_seconds ]
+            self.stats['evicted'] += len(expired)
+        for cnxn in expired:
+            self.close(cnxn)
+
+    def schedule_eviction(self):
+        ''' Evicts the idle connections once they expire, even if the pool is not used again by then. '''
+        def run():
+            with self.lock:
+                self.timer = None
+            self.evict_idle()
+            self.schedule_eviction()
+        with self.lock:
+            if self.timer is not None or not self.idle:
+                return
+            delay = self.idle[0][1] + self.idle_seconds - time.time() + 1
+            self.timer = threading.Timer(max(delay, 1), run)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def acquire(self):
+        self.evict_idle()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                cnxn, _ = self.idle.pop() # most recently used first
+            if self.is_healthy(cnxn):
+                with self.lock:
+                    self.stats['reused'] += 1
+                return cnxn
+            with self.lock:
+                self.stats['unhealthy'] += 1
+            self.close(cnxn)
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        start = time.time()
+        try:
+            cnxn = self.connect()
+        except:
+            if self.semaphore is not None:
+                self.semaphore.release()
+            raise
+        with self.lock:
+            self.stats['created'] += 1
+            self.stats['connect_seconds'] += time.time() - start
+        return cnxn
+
+    def release(self, cnxn, healthy=True):
+        if healthy:
+            try:
+                cnxn.rollback() # so that the next user does not see an old snapshot
+            except pyodbc.Error:
+                healthy = False
+        with self.lock:
+            keep = healthy and len(self.idle) < self.max_idle
+            if keep:
+                self.idle.append( (cnxn, time.time()) )
+        if not keep:
+            self.close(cnxn)
+        self.evict_idle()
+        self.schedule_eviction()
+
+    @contextlib.contextmanager
+    def connection(self):
+        cnxn = self.acquire()
+        try:
+            yield cnxn
+        except:
+            self.release(cnxn, healthy=False)
+            raise
+        self.release(cnxn)
+
+def encode_watermark(value):
+    ''' Makes an incremental mark JSON serializable. '''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return {'type': type(value).__name__, 'value': value.isoformat()}
+    elif isinstance(value, decimal.Decimal):
+        return {'type': 'decimal', 'value': str(value)}
+    return value
+
+def decode_watermark(value):
+    if isinstance(value, dict):
+        return {'datetime': datetime.datetime.fromisoformat,
+                'date': datetime.date.fromisoformat,
+                'decimal': decimal.Decimal}[value['type']](value['value'])
+    return value
+
+json_value = json.JSONEncoder().encode
+json_string = json.encoder.encode_basestring_ascii
+
+def json_str(value):
+    return json_string(str(value))
+
+def json_float(value):
+    text = float.__repr__(value)
+    return text if text[-1].isdigit() else json_value(value) # NaN and Infinity
+
+def json_bytes(value):
+    return '"' + base64.b64encode(value).decode('ascii') + '"'
+
+json_type_converters = { str: json_string, int: int.__repr__, bool: json_value, float: json_float,
+                         decimal.Decimal: str, bytes: json_bytes, bytearray: json_bytes }
+
+def json_any(value):
+    ''' For the columns whose type is not known up front, such as the ones computed by ``custom_sql``. '''
+    return json_type_converters.get(type(value), json_str)(value)
+
+class IdentityCompressor(object):
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+def get_compressor(compression):
+    ''' Returns an in-process streaming compressor object with ``compress`` and ``flush`` methods. '''
+    if compression == 'gz':
+        return zlib.compressobj(wbits=31) # gzip container
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    elif compression is None:
+        return IdentityCompressor()
+    raise Exception(f"Unsupported compression {compression}")
+
+def get_s3_client(credentials):
+    ''' A boto3 S3 client with the AWS keys of the sensor credentials, the same ones treldev.S3Commands uses, or the default credential chain if there are none. '''
+    global boto3
+    import boto3
+    if 'aws.access_key' in credentials:
+        return boto3.client('s3', aws_access_key_id=credentials['aws.access_key'],
+                            aws_secret_access_key=credentials['aws.secret_access_key'])
+    return boto3.client('s3')
+
+class S3MultipartWriter(object):
+    ''' Uploads everything written to it to ``uri`` as an S3 multipart upload. At most ``chunk_bytes`` are held in memory and nothing touches the disk. '''
+
+    def __init__(self, client, uri, chunk_bytes):
+        _,_,self.bucket, self.key = uri.split('/',3)
+        self.client = client
+        self.chunk_bytes = max(chunk_bytes, 5*1024**2) # S3 minimum for all but the last part
+        self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        self.parts = []
+        self.buffer = bytearray()
+        self.size = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= self.chunk_bytes:
+            self.upload_part()
+
+    def upload_part(self):
+        part_number = len(self.parts) + 1
+        res = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                      PartNumber=part_number, Body=bytes(self.buffer))
+        self.parts.append({'PartNumber': part_number, 'ETag': res['ETag']})
+        self.buffer.clear()
+
+    def close(self):
+        if self.buffer or not self.parts:
+            self.upload_part()
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
 
 class DestinationProtocol(object):
 
     registered = {}
+    arrow_type_mapping = {
+        pyodbc.SQL_CHAR: 'string',
+        pyodbc.SQL_VARCHAR: 'string',
+        pyodbc.SQL_LONGVARCHAR: 'string',
+        pyodbc.SQL_WCHAR: 'string',
+        pyodbc.SQL_WVARCHAR: 'string',
+        pyodbc.SQL_WLONGVARCHAR: 'string',
+        pyodbc.SQL_GUID: 'string',
+        pyodbc.SQL_TYPE_DATE: 'date32',
+        pyodbc.SQL_TYPE_TIME: 'time64',
+        pyodbc.SQL_TYPE_TIMESTAMP: 'timestamp',
+        pyodbc.SQL_BINARY: 'binary',
+        pyodbc.SQL_VARBINARY: 'binary',
+        pyodbc.SQL_DECIMAL: 'decimal128',
+        pyodbc.SQL_NUMERIC: 'decimal128',
+        pyodbc.SQL_SMALLINT: 'int64',
+        pyodbc.SQL_INTEGER: 'int64',
+        pyodbc.SQL_BIT: 'bool_',
+        pyodbc.SQL_TINYINT: 'int64',
+        pyodbc.SQL_BIGINT: 'int64',
+        pyodbc.SQL_REAL: 'float64',
+        pyodbc.SQL_FLOAT: 'float64',
+        pyodbc.SQL_DOUBLE: 'float64',
+    } # anything else, such as intervals, is written as a string
+    string_types = { pyodbc.SQL_CHAR, pyodbc.SQL_VARCHAR, pyodbc.SQL_LONGVARCHAR, pyodbc.SQL_WCHAR, pyodbc.SQL_WVARCHAR, pyodbc.SQL_WLONGVARCHAR }
+    parquet_compression = { 'gz': 'gzip', None: 'none' }
+    compression_extensions = { 'gz': '.gz', 'zstd': '.zst', None: '' }
+    # Each converter renders a non-NULL value as JSON text. Anything not listed, such as intervals, is rendered as a string.
+    json_converters = {
+        pyodbc.SQL_CHAR: json_string,
+        pyodbc.SQL_VARCHAR: json_string,
+        pyodbc.SQL_LONGVARCHAR: json_string,
+        pyodbc.SQL_WCHAR: json_string,
+        pyodbc.SQL_WVARCHAR: json_string,
+        pyodbc.SQL_WLONGVARCHAR: json_string,
+        pyodbc.SQL_BINARY: json_bytes,
+        pyodbc.SQL_VARBINARY: json_bytes,
+        pyodbc.SQL_DECIMAL: str,
+        pyodbc.SQL_NUMERIC: str,
+        pyodbc.SQL_SMALLINT: int.__repr__,
+        pyodbc.SQL_INTEGER: int.__repr__,
+        pyodbc.SQL_BIT: json_value,
+        pyodbc.SQL_TINYINT: int.__repr__,
+        pyodbc.SQL_BIGINT: int.__repr__,
+        pyodbc.SQL_REAL: json_float,
+        pyodbc.SQL_FLOAT: json_float,
+        pyodbc.SQL_DOUBLE: json_float,
+    }
     
     @classmethod
     def register(cls):
@@ -172,30 +998,179 @@ class DestinationProtocol(object):
     def __init__(self, uri, sensor):
         self.uri = uri
         self.sensor = sensor
+        self.local = threading.local()
     
-    def prepare(self):
-        self.batch_num = 0
+    def prepare(self, resume_state=None):
+        ''' ``resume_state``, as returned by ``get_resume_state`` in an earlier attempt, continues that attempt instead of starting over. '''
+        self.resume_state = resume_state
         self.col_names = []
         for col in self.sensor.columns:
             self.col_names.append( col.column_name )
+        if self.sensor.output_format == 'parquet':
+            global pa, pq
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self.arrow_schema = pa.schema([ pa.field(col.column_name, self.get_arrow_type(col), nullable=bool(col.nullable))
+                                            for col in self.sensor.columns ])
+            # values of the columns written as strings that pyodbc does not return as str, e.g. timedelta or UUID
+            self.str_columns = [ field.type == pa.string() and col.data_type not in self.string_types
+                                 for col, field in zip(self.sensor.columns, self.arrow_schema) ]
+        else:
+            assert self.sensor.output_format == 'json', f"Unsupported output_format {self.sensor.output_format}"
+            self.encode_rows = None # compiled by describe for the statement that runs
+            if self.sensor.compression not in ('gz', None) and not self.sensor.streaming_upload:
+                raise Exception(f"compression {self.sensor.compression} of json parts needs streaming_upload")
+        if self.sensor.streaming_upload and not (self.sensor.output_format == 'json' and hasattr(self, 'open_stream')):
+            raise Exception(f"streaming_upload is not supported for {self.protocol} with output_format {self.sensor.output_format}")
         self.prepare_inner()
 
-    def append_data(self, file_name):
-        self.append_data_inner(file_name)
-        self.batch_num += 1
+    def describe(self, description):
+        ''' Called with the ``cursor.description`` of the statement that runs, before its first batch is queued. '''
+        if self.sensor.output_format == 'json' and self.encode_rows is None:
+            self.encode_rows = self.compile_json_encoder([ d[0] for d in description ])
+
+    def compile_json_encoder(self, names=None):
+        ''' Returns a function that encodes a list of rows as newline delimited JSON. The converter and the rendered key of each column are looked up once here, not per cell. The output is the same as ``json.dump`` of a dict of the non-NULL values.
+
+        ``names`` are the columns of the rows, by default those of the table. With ``custom_sql`` they can be in another order or a subset, and a column the table does not have is converted by the type of each value. '''
+        data_types = { col.column_name.lower(): col.data_type for col in self.sensor.columns }
+        if names is None:
+            names = [ col.column_name for col in self.sensor.columns ]
+        columns = tuple( (json.dumps(name) + ': ', self.json_converters.get(data_types[name.lower()], json_str) if name.lower() in data_types else json_any)
+                         for name in names )
+        def encode_rows(rows):
+            return ''.join([ '{' + ', '.join([ key + convert(value)
+                                               for (key, convert), value in zip(columns, row)
+                                               if value is not None ]) + '}\n'
+                             for row in rows ])
+        return encode_rows
+
+    def get_resume_state(self):
+        return {}
+
+    def get_arrow_type(self, col):
+        type_name = self.arrow_type_mapping.get(col.data_type, 'string')
+        if type_name == 'decimal128':
+            # MariaDB allows a precision of up to 65
+            if col.column_size <= 38:
+                return pa.decimal128(col.column_size, col.decimal_digits or 0)
+            elif col.column_size <= 76:
+                return pa.decimal256(col.column_size, col.decimal_digits or 0)
+            return pa.string()
+        elif type_name in ('time64', 'timestamp'):
+            return getattr(pa, type_name)('us')
+        return getattr(pa, type_name)()
+
+    def upload_batch(self, chunks, batch_num):
+        ''' Writes the batch out and returns the seconds spent per stage and the bytes uploaded. '''
+        self.local.stats = collections.Counter()
+        if self.sensor.streaming_upload:
+            print(f"Streaming batch {batch_num} to {self.uri}",file=sys.stderr)
+            self.stream_batch(chunks, batch_num)
+        else:
+            with self.timed('encode'):
+                filename = self.write_batch_to_file(chunks)
+            print(f"Uploading batch {batch_num} data from {filename} to {self.uri}",file=sys.stderr)
+            self.append_data(filename, batch_num)
+        return self.local.stats
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        ''' Adds the time spent in the block to the stats of the batch being uploaded by this thread. '''
+        start = time.time()
+        yield
+        self.local.stats[stage + '_seconds'] += time.time() - start
+
+    def count_bytes(self, num_bytes):
+        self.local.stats['bytes'] += num_bytes
+
+    def append_data(self, file_name, batch_num):
+        self.append_data_inner(file_name, batch_num)
 
     def finish(self):
         self.finish_inner()
 
-    def write_row_to_file(self, row, f):
-        for i in range(len(row)):
-            if type(row[i]) is datetime.datetime:
-                row[i] = str(row[i])
-        json.dump(dict(filter((lambda x: x[1] is not None), zip(self.col_names, row))), f)
-        f.write('\n')
-    
-    def get_next_batch_num(self):
-        return self.batch_num
+    def record_watermarks(self, low, high):
+        ''' Stores the incremental range of this dataset along with it. '''
+        self.record_watermarks_inner(json.dumps({ self.sensor.incremental_column: [ encode_watermark(low), encode_watermark(high) ] }))
+
+    def read_watermarks(self):
+        ''' Returns the encoded [low, high] marks stored with this dataset by ``record_watermarks``, or None. Needs no ``prepare``. '''
+        text = self.read_watermarks_inner()
+        if not text:
+            return None
+        return json.loads(text).get(self.sensor.incremental_column)
+
+    def stream_batch(self, chunks, batch_num):
+        ''' Encodes and compresses the batch in memory straight into the writers returned by ``open_stream``, which destinations supporting ``streaming_upload`` implement. The batch rolls over to a new file, part-<batch>-<n>, every ``part_size_bytes`` of compressed output. '''
+        extension = self.compression_extensions[self.sensor.compression]
+        writer = None
+        file_num = 0
+        try:
+            for rows in chunks:
+                if writer is None:
+                    compressor = get_compressor(self.sensor.compression)
+                    writer = self.open_stream(f"part-{batch_num:>05}-{file_num:>05}{extension}")
+                with self.timed('encode'):
+                    data = self.encode_rows(rows).encode('ascii')
+                with self.timed('compress'):
+                    data = compressor.compress(data)
+                with self.timed('upload'):
+                    writer.write(data)
+                if writer.size >= self.sensor.part_size_bytes:
+                    with self.timed('upload'):
+                        writer.write(compressor.flush())
+                        writer.close()
+                    self.count_bytes(writer.size)
+                    writer = None
+                    file_num += 1
+            if writer is None and file_num == 0: # keep an empty file for an empty batch
+                compressor = get_compressor(self.sensor.compression)
+                writer = self.open_stream(f"part-{batch_num:>05}-{file_num:>05}{extension}")
+            if writer is not None:
+                with self.timed('upload'):
+                    writer.write(compressor.flush())
+                    writer.close()
+                self.count_bytes(writer.size)
+        except:
+            if writer is not None:
+                writer.abort()
+            raise
+
+    def compress_part(self, filename, batch_num):
+        ''' Compresses a file written by ``write_batch_to_file`` as configured. Returns the resulting file name and the part name to store it under. '''
+        if self.sensor.output_format == 'parquet':
+            # parquet compresses internally
+            return filename, f"part-{batch_num:>05}.parquet"
+        elif self.sensor.compression == 'gz':
+            with self.timed('compress'):
+                subprocess.check_call(f"gzip {filename}", shell=True)
+            return filename + '.gz', f"part-{batch_num:>05}.gz"
+        return filename, f"part-{batch_num:>05}"
+
+    def write_batch_to_file(self, chunks):
+        ''' Serializes a batch, given as an iterable of ``fetchmany`` results, into a new temporary file in ``output_format``. Returns the file name. '''
+        if self.sensor.output_format == 'parquet':
+            return self.write_parquet_to_file(chunks)
+        with tempfile.NamedTemporaryFile('w+', delete=False) as f:
+            for rows in chunks:
+                f.write(self.encode_rows(rows))
+        return f.name
+
+    def write_parquet_to_file(self, chunks):
+        ''' Builds one Arrow record batch per ``fetchmany`` result and writes them all as a single row group. '''
+        record_batches = []
+        for rows in chunks:
+            columns = zip(*rows)
+            record_batches.append( pa.RecordBatch.from_arrays([ pa.array([ None if v is None else str(v) for v in values ] if to_str else values, type=field.type)
+                                                                for values, field, to_str in zip(columns, self.arrow_schema, self.str_columns) ],
+                                                              schema=self.arrow_schema) )
+        table = pa.Table.from_batches(record_batches, schema=self.arrow_schema)
+        fd, filename = tempfile.mkstemp(suffix='.parquet')
+        os.close(fd)
+        pq.write_table(table, filename, row_group_size=max(table.num_rows, 1),
+                       compression=self.parquet_compression.get(self.sensor.compression, self.sensor.compression))
+        return filename
 
 class S3Destination(DestinationProtocol):
 
@@ -203,24 +1178,220 @@ class S3Destination(DestinationProtocol):
 
     def prepare_inner(self):
         self.s3_commands = treldev.S3Commands(credentials=self.sensor.credentials)
+        if self.sensor.streaming_upload:
+            self.s3_client = get_s3_client(self.sensor.credentials)
 
-    
-    def append_data_inner(self, filename):
-        if self.sensor.compression == 'gz':
-            subprocess.check_call(f"gzip {filename}", shell=True)
-            filename = filename + '.gz'
-            file_uri = self.uri + f"part-{self.batch_num:>05}.gz"
-        else:
-            file_uri = self.uri + f"part-{self.batch_num:>05}"
-        self.s3_commands.upload_file(filename, file_uri)
+    def open_stream(self, part_name):
+        return S3MultipartWriter(self.s3_client, self.uri + part_name, self.sensor.multipart_chunk_bytes)
+
+    def append_data_inner(self, filename, batch_num):
+        filename, part_name = self.compress_part(filename, batch_num)
+        self.count_bytes(os.path.getsize(filename))
+        with self.timed('upload'):
+            self.s3_commands.upload_file(filename, self.uri + part_name)
         os.remove(filename)
 
+    def record_watermarks_inner(self, watermarks):
+        with tempfile.NamedTemporaryFile('w') as f:
+            f.write(watermarks)
+            f.flush()
+            self.s3_commands.upload_file(f.name, self.uri+'_WATERMARKS')
+
+    def read_watermarks_inner(self):
+        _, _, bucket, prefix = self.uri.split('/',3)
+        client = get_s3_client(self.sensor.credentials)
+        try:
+            return client.get_object(Bucket=bucket, Key=prefix+'_WATERMARKS')['Body'].read().decode()
+        except client.exceptions.NoSuchKey:
+            return None
+
     def finish_inner(self):
         with tempfile.NamedTemporaryFile('w') as f:
             self.s3_commands.upload_file(f.name, self.uri+'_SUCCESS')
             f.close()
 S3Destination.register()
 
+
+class LocalFileWriter(object):
+    ''' Same interface as S3MultipartWriter, for a local file. '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.f.close()
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.filename)
+
+class LocalDestination(DestinationProtocol):
+    ''' Writes the same part files as S3Destination into a local folder, given as file:///path/. Meant for testing and benchmarks. '''
+
+    protocol = 'file'
+
+    def prepare_inner(self):
+        self.path = self.uri[len('file://'):]
+        os.makedirs(self.path, exist_ok=True)
+
+    def open_stream(self, part_name):
+        return LocalFileWriter(os.path.join(self.path, part_name))
+
+    def append_data_inner(self, filename, batch_num):
+        filename, part_name = self.compress_part(filename, batch_num)
+        self.count_bytes(os.path.getsize(filename))
+        with self.timed('upload'):
+            shutil.move(filename, os.path.join(self.path, part_name))
+
+    def record_watermarks_inner(self, watermarks):
+        with open(os.path.join(self.path, '_WATERMARKS'), 'w') as f:
+            f.write(watermarks)
+
+    def read_watermarks_inner(self):
+        filename = os.path.join(self.uri[len('file://'):], '_WATERMARKS')
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            return f.read()
+
+    def finish_inner(self):
+        open(os.path.join(self.path, '_SUCCESS'), 'w').close()
+LocalDestination.register()
+
+def compose_blobs(bucket, name, blobs, temp_prefix):
+    ''' Concatenates ``blobs`` into the object ``name``. A compose request takes at most 32 sources, so longer lists are composed in rounds through intermediate objects under ``temp_prefix``, which are deleted afterwards. '''
+    intermediates = []
+    while len(blobs) > 32:
+        groups = [ blobs[i:i+32] for i in range(0, len(blobs), 32) ]
+        blobs = []
+        for group in groups:
+            intermediate = bucket.blob(f"{temp_prefix}compose-{len(intermediates):>05}")
+            intermediate.compose(group)
+            intermediates.append(intermediate)
+            blobs.append(intermediate)
+    bucket.blob(name).compose(blobs)
+    bucket.delete_blobs(intermediates, on_error=lambda blob: None)
+
+class GCSCompositeWriter(object):
+    ''' Same interface as S3MultipartWriter, for Google Storage. Every ``chunk_bytes`` written are uploaded by ``executor`` as a separate component while writing goes on, with at most ``max_pending`` of them in memory. ``close`` composes the components into ``name``. '''
+
+    def __init__(self, bucket, name, component_prefix, chunk_bytes, executor, max_pending):
+        self.bucket = bucket
+        self.name = name
+        self.component_prefix = component_prefix
+        self.chunk_bytes = chunk_bytes
+        self.executor = executor
+        self.max_pending = max_pending
+        self.components = []
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.size = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= self.chunk_bytes:
+            self.upload_component()
+
+    def upload_component(self):
+        blob = self.bucket.blob(f"{self.component_prefix}{len(self.components):>05}")
+        self.components.append(blob)
+        self.pending.append(self.executor.submit(blob.upload_from_string, bytes(self.buffer)))
+        self.buffer.clear()
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft().result()
+
+    def wait(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        if not self.components:
+            # small enough for a single request
+            self.bucket.blob(self.name).upload_from_string(bytes(self.buffer))
+            return
+        if self.buffer:
+            self.upload_component()
+        self.wait()
+        compose_blobs(self.bucket, self.name, self.components, self.component_prefix)
+        self.bucket.delete_blobs(self.components, on_error=lambda blob: None)
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        concurrent.futures.wait(self.pending)
+        self.bucket.delete_blobs(self.components, on_error=lambda blob: None)
+
+class GCSDestination(DestinationProtocol):
+    ''' Writes the same part files, _WATERMARKS and _SUCCESS as S3Destination to gs://bucket/prefix/. Large parts are uploaded in parallel as composite objects. Components live under _COMPONENTS/ until they are composed. '''
+
+    protocol = 'gs'
+
+    def prepare_inner(self):
+        import treldev.gcputils
+        self.storage_client = treldev.gcputils.Storage.get_client()
+        _, _, bucket, self.prefix = self.uri.split('/',3)
+        self.bucket = self.storage_client.bucket(bucket)
+        self.component_prefix = f"{self.prefix}_COMPONENTS/{uuid.uuid4().hex}/"
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.sensor.composite_upload_threads)
+
+    def open_stream(self, part_name):
+        return GCSCompositeWriter(self.bucket, self.prefix + part_name, f"{self.component_prefix}{part_name}/",
+                                  self.sensor.multipart_chunk_bytes, self.executor, self.sensor.composite_upload_threads)
+
+    def append_data_inner(self, filename, batch_num):
+        filename, part_name = self.compress_part(filename, batch_num)
+        size = os.path.getsize(filename)
+        self.count_bytes(size)
+        with self.timed('upload'):
+            if size < self.sensor.composite_threshold_bytes:
+                self.bucket.blob(self.prefix + part_name).upload_from_filename(filename)
+            else:
+                self.upload_composite(filename, part_name, size)
+        os.remove(filename)
+
+    def upload_composite(self, filename, part_name, size):
+        ''' Uploads up to 32 ranges of the file in parallel and composes them into the part. '''
+        chunk_bytes = max(self.sensor.multipart_chunk_bytes, -(-size // 32))
+        component_prefix = f"{self.component_prefix}{part_name}/"
+        components = [ self.bucket.blob(f"{component_prefix}{i:>05}") for i in range(-(-size // chunk_bytes)) ]
+        def upload_range(blob, offset):
+            with open(filename, 'rb') as f:
+                f.seek(offset)
+                blob.upload_from_file(f, size=min(chunk_bytes, size - offset))
+        futures = []
+        try:
+            futures = [ self.executor.submit(upload_range, blob, i * chunk_bytes) for i, blob in enumerate(components) ]
+            for future in futures:
+                future.result()
+            compose_blobs(self.bucket, self.prefix + part_name, components, component_prefix)
+        finally:
+            concurrent.futures.wait(futures)
+            self.bucket.delete_blobs(components, on_error=lambda blob: None)
+
+    def record_watermarks_inner(self, watermarks):
+        self.bucket.blob(self.prefix+'_WATERMARKS').upload_from_string(watermarks)
+
+    def read_watermarks_inner(self):
+        import treldev.gcputils
+        _, _, bucket, prefix = self.uri.split('/',3)
+        blob = treldev.gcputils.Storage.get_client().bucket(bucket).blob(prefix+'_WATERMARKS')
+        return blob.download_as_text() if blob.exists() else None
+
+    def finish_inner(self):
+        self.executor.shutdown()
+        # components left behind by failed attempts
+        self.bucket.delete_blobs(list(self.storage_client.list_blobs(self.bucket, prefix=self.prefix+'_COMPONENTS/')), on_error=lambda blob: None)
+        self.bucket.blob(self.prefix+'_SUCCESS').upload_from_string('')
+GCSDestination.register()
+
+
             
 class BigQueryDestination(DestinationProtocol):
 
@@ -266,54 +1437,138 @@ class BigQueryDestination(DestinationProtocol):
     }
     
     def prepare_inner(self):
-        global bigquery, BigQuery, BigQueryURI, base64
+        global bigquery, BigQuery, BigQueryURI
+        if self.sensor.checkpoint_column is not None and self.sensor.bq_staging_uri is None:
+            # a load job that finished before its batch was recorded would be appended again on resume
+            raise Exception("checkpoint_column needs bq_staging_uri for BigQuery destinations")
 
-        assert self.sensor.output_format == 'json'
-        
         from treldev.gcputils import BigQuery, BigQueryURI
         import treldev.gcputils
         from google.cloud import bigquery
-        import base64
 
         self.client = treldev.gcputils.BigQuery.get_client()
         for col in self.sensor.columns:
-            bq_type = self.type_mapping[col.data_type]
+            bq_type = self.get_bq_type(col)
             print(f"{col.column_name}:{bq_type},", file=sys.stderr,end='')
         print("", file=sys.stderr)
 
         self.schema = []
         self.bquri = BigQueryURI(self.uri)
         for col in self.sensor.columns:
-            bq_type = self.type_mapping[col.data_type]
+            bq_type = self.get_bq_type(col)
             self.schema.append( bigquery.SchemaField(col.column_name, bq_type, mode=("NULLABLE" if col.nullable else "REQUIRED")) )
+        self.source_format = (bigquery.SourceFormat.PARQUET
+                              if self.sensor.output_format == 'parquet'
+                              else bigquery.SourceFormat.NEWLINE_DELIMITED_JSON)
+        self.description = None
+
+        if self.sensor.bq_staging_uri is not None:
+            # the final table is left alone until finish_inner swaps in the new one
+            self.storage_client = treldev.gcputils.Storage.get_client()
+            _, _, bucket, prefix = self.sensor.bq_staging_uri.split('/',3)
+            self.staging_bucket = self.storage_client.bucket(bucket)
+            if self.resume_state is not None:
+                self.staging_prefix = self.resume_state['staging_prefix']
+            else:
+                self.staging_prefix = f"{prefix}{self.bquri.path}/{uuid.uuid4().hex}/"
+            print(f"Staging batches in gs://{bucket}/{self.staging_prefix}", file=sys.stderr)
+            return
+        
         self.client.delete_table(self.bquri.path, not_found_ok=True)
         table = bigquery.Table(self.bquri.path, schema=self.schema)
         
         table = self.client.create_table(table)
         print("Created table {}.{}.{}".format(table.project, table.dataset_id, table.table_id), file=sys.stderr)
         
-    def write_row_to_file(self, row, f):
-        for i in range(len(row)):
-            bq_type = self.type_mapping[self.sensor.columns[i].data_type]
-            if bq_type in ('DATE','TIME','DATETIME','INTERVAL'):
-                if row[i] is not None:
-                    row[i] = str(row[i])
-            elif bq_type == 'BYTES':
-                if row[i] is not None:
-                    row[i] = base64.b64encode(row[i]).decode('utf-8')
-        json.dump(dict(filter((lambda x: x[1] is not None), zip(self.col_names, row))), f)
-        f.write('\n')
-    
-    def append_data_inner(self, filename):
+    def get_bq_type(self, col):
+        if col.data_type == pyodbc.SQL_BIT and self.sensor.output_format == 'parquet':
+            return 'BOOL' # parquet stores bits as booleans
+        return self.type_mapping[col.data_type]
+
+    def append_data_inner(self, filename, batch_num):
+        if self.sensor.bq_staging_uri is not None:
+            return self.stage_file(filename, batch_num)
         loadjob_config_dict = {
             'write_disposition': bigquery.WriteDisposition.WRITE_APPEND,
-            'source_format': bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            'source_format': self.source_format,
             }
-        self.bquri.load_file(filename, loadjob_config_dict)
+        self.count_bytes(os.path.getsize(filename))
+        with self.timed('upload'):
+            self.bquri.load_file(filename, loadjob_config_dict)
+        os.remove(filename)
+
+    def get_resume_state(self):
+        if self.sensor.bq_staging_uri is not None:
+            return {'staging_prefix': self.staging_prefix}
+        return {}
+
+    def stage_file(self, filename, batch_num):
+        if self.sensor.output_format == 'parquet':
+            blob_name = self.staging_prefix + f"part-{batch_num:>05}.parquet"
+        else:
+            compressed_filename = filename + '.gz'
+            with self.timed('compress'):
+                with open(filename, 'rb') as f_in, gzip.open(compressed_filename, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out, 1024**2)
+            os.remove(filename)
+            filename = compressed_filename
+            blob_name = self.staging_prefix + f"part-{batch_num:>05}.gz"
+        self.count_bytes(os.path.getsize(filename))
+        with self.timed('upload'):
+            self.staging_bucket.blob(blob_name).upload_from_filename(filename)
         os.remove(filename)
         
+    def record_watermarks_inner(self, watermarks):
+        self.description = f"watermarks: {watermarks}"
+        if self.sensor.bq_staging_uri is None:
+            self.set_description(self.bquri.path)
+
+    def read_watermarks_inner(self):
+        import treldev.gcputils
+        from google.api_core.exceptions import NotFound
+        try:
+            table = treldev.gcputils.BigQuery.get_client().get_table(treldev.gcputils.BigQueryURI(self.uri).path)
+        except NotFound:
+            return None
+        if table.description and table.description.startswith('watermarks: '):
+            return table.description[len('watermarks: '):]
+        return None
+
+    def set_description(self, path):
+        table = self.client.get_table(path)
+        table.description = self.description
+        self.client.update_table(table, ['description'])
+
     def finish_inner(self):
-        pass
+        if self.sensor.bq_staging_uri is not None:
+            self.load_staged()
+
+    def load_staged(self):
+        ''' Loads every staged file with a single load job into a temporary table, then replaces the final table with it in one copy job, so readers never see a partially loaded table. If either job fails and a checkpoint is kept, the staged files stay for the next attempt, which resumes from them. '''
+        temp_path = f"{self.bquri.path}_staging_{uuid.uuid4().hex[:8]}"
+        source_uri = f"gs://{self.staging_bucket.name}/{self.staging_prefix}part-*"
+        job_config = bigquery.LoadJobConfig(schema=self.schema,
+                                            source_format=self.source_format,
+                                            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+        try:
+            print(f"Loading {source_uri} into {temp_path}", file=sys.stderr)
+            self.client.load_table_from_uri(source_uri, temp_path, job_config=job_config).result()
+            if self.description is not None:
+                self.set_description(temp_path)
+            print(f"Swapping {temp_path} into {self.bquri.path}", file=sys.stderr)
+            copy_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+            self.client.copy_table(temp_path, self.bquri.path, job_config=copy_config).result()
+        except Exception:
+            if self.sensor.checkpoint_column is None:
+                self.delete_staged() # the next attempt stages under a new prefix
+            raise
+        finally:
+            self.client.delete_table(temp_path, not_found_ok=True)
+        self.delete_staged()
+
+    def delete_staged(self):
+        for blob in self.storage_client.list_blobs(self.staging_bucket, prefix=self.staging_prefix):
+            blob.delete()
 BigQueryDestination.register()
         
 if __name__ == '__main__':
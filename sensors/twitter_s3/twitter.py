@@ -5,18 +5,20 @@ Credentials required:
 
 Packages required:
 - tweepy==3.10.0
+
+The tweets crawled are kept in a SQLite file (``crawl_cache_file``, by default under ~/.twitter_crawl_cache/), along with the time ranges it holds every tweet for. A backfill crawls back once from now through all the missing instances, skipping ranges cached by earlier crawls, and later instances are served from the cache.
 '''
 
-import tweepy, json, yaml, os, unittest, croniter, time, datetime, tempfile, sys
+import tweepy, json, yaml, os, unittest, croniter, time, datetime, tempfile, sys, sqlite3, re
 import treldev
 
-def crawl(hashtag, credentials, tweets_per_query = 100, max_tweets = 1000000, since_id=None, logger=None, until=None):
-    ''' Yields tweets for the hashtag '''
+def crawl(hashtag, credentials, tweets_per_query = 100, max_tweets = 1000000, since_id=None, logger=None, until=None, max_id=None):
+    ''' Yields tweets for the hashtag, newest first, starting at max_id if given. Returns True, as the value of its StopIteration, if it ran out of tweets rather than stopping at max_tweets. '''
     authentication = tweepy.OAuthHandler(credentials['consumer_key'], credentials['consumer_secret'])
     authentication.set_access_token(credentials['access_token'], credentials['access_secret'])
     api = tweepy.API(authentication, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
     
-    min_id = None
+    min_id = None if max_id is None else max_id + 1
     tweet_count = 0
     while tweet_count < max_tweets:
         extra_args = {} if min_id is None else {'max_id': str(min_id - 1)}
@@ -29,12 +31,12 @@ def crawl(hashtag, credentials, tweets_per_query = 100, max_tweets = 1000000, si
             continue
         #p#rint( 'tweet_count', tweet_count, min_id, len(res), until, extra_args )
         if not res:
-            return
+            return True
         
         for tweet in res:
             #print(json.dumps(tweet._json))
             if since_id is not None and tweet._json['id'] < since_id:
-                return
+                return True
 
             try:
                 tweet._json['created_ts'] = str(datetime.datetime.strptime(tweet._json['created_at'],'%a %b %d %H:%M:%S +0000 %Y'))
@@ -61,6 +63,62 @@ class Test(unittest.TestCase):
         for e,r in crawl('#amc',credentials['twitter'], max_tweets=13, tweets_per_query=3, logger=logging.getLogger()):
             print(r)
         
+class TweetCache(object):
+    ''' The tweets of one hashtag in a SQLite file. Each row of ``ranges`` records that every tweet created after start_ts and before end_ts is in ``tweets``. Its min_id is the oldest tweet a crawl saw there, so a later crawl can continue from below it. A start_ts of '' means Twitter had nothing older. '''
+
+    def __init__(self, filename):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.db = sqlite3.connect(filename)
+        self.db.execute("create table if not exists tweets (id integer primary key, created_ts text, tweet text)")
+        self.db.execute("create index if not exists tweets_created_ts on tweets (created_ts)")
+        self.db.execute("create table if not exists ranges (start_ts text, end_ts text, min_id integer)")
+        self.db.commit()
+
+    def add_range(self, start_ts, end_ts, min_id):
+        return self.db.execute("insert into ranges values (?,?,?)", (start_ts, end_ts, min_id)).lastrowid
+
+    def add(self, tweet, range_id):
+        ''' Adds a tweet reached by the crawl whose range is range_id, extending the range down to it. Returns the range the crawl ran into, if any, which it then absorbs. '''
+        self.db.execute("insert or replace into tweets values (?,?,?)", (tweet['id'], tweet['created_ts'], json.dumps(tweet)))
+        self.db.execute("update ranges set start_ts = ?, min_id = ? where rowid = ?", (tweet['created_ts'], tweet['id'], range_id))
+        return self.absorb(range_id)
+
+    def absorb(self, range_id):
+        ''' Merges the ranges overlapping range_id into it. Returns the (start_ts, min_id) of the oldest one merged, if it reaches below range_id. '''
+        start_ts, end_ts, min_id = self.db.execute("select start_ts, end_ts, min_id from ranges where rowid = ?", (range_id,)).fetchone()
+        overlapping = self.db.execute("select rowid, start_ts, end_ts, min_id from ranges where rowid != ? and end_ts >= ? and start_ts < ?",
+                                      (range_id, start_ts, end_ts)).fetchall()
+        older = None
+        for rowid, other_start_ts, other_end_ts, other_min_id in overlapping:
+            self.db.execute("delete from ranges where rowid = ?", (rowid,))
+            end_ts = max(end_ts, other_end_ts)
+            if other_start_ts < start_ts:
+                start_ts, min_id = other_start_ts, other_min_id
+                older = (start_ts, min_id)
+        self.db.execute("update ranges set start_ts = ?, end_ts = ?, min_id = ? where rowid = ?", (start_ts, end_ts, min_id, range_id))
+        return older
+
+    def complete(self, range_id):
+        ''' Records that Twitter has nothing older than the crawl of range_id. '''
+        self.db.execute("update ranges set start_ts = '' where rowid = ?", (range_id,))
+        self.absorb(range_id)
+
+    def covers(self, start_ts, end_ts):
+        return self.db.execute("select count(*) from ranges where start_ts < ? and end_ts >= ?", (start_ts, end_ts)).fetchone()[0] > 0
+
+    def tweets(self, start_ts, end_ts):
+        for tweet, in self.db.execute("select tweet from tweets where created_ts >= ? and created_ts < ? order by id desc", (start_ts, end_ts)):
+            yield json.loads(tweet)
+
+    def prune(self, before_ts):
+        ''' Drops the tweets created before before_ts. The ranges still hold every tweet after it. '''
+        self.db.execute("delete from tweets where created_ts < ?", (before_ts,))
+        self.db.execute("delete from ranges where end_ts < ?", (before_ts,))
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
 class TwitterSensor(treldev.Sensor):
 
     def __init__(self, config, credentials, *args, **kwargs):
@@ -71,6 +129,9 @@ class TwitterSensor(treldev.Sensor):
         self.hashtag = self.config['hashtag']
         self.lookback_seconds = self.config['max_instance_age_seconds'] - 1 # how far we should backfill missing datasets
         self.locking_seconds = self.config.get('locking_seconds',600)
+        self.max_tweets = self.config.get('max_tweets',10000) # crawled per instance at most
+        self.cache = TweetCache(os.path.expanduser(self.config.get('crawl_cache_file', f"~/.twitter_crawl_cache/{re.sub(r'[^A-Za-z0-9]+', '_', self.hashtag)}.sqlite")))
+        self.crawler = None
     
     def get_new_datasetspecs(self, datasets):
         ''' If there is data ready to be inserted, this should return a datasetspec. Else, return None '''
@@ -95,6 +156,8 @@ class TwitterSensor(treldev.Sensor):
         index_ts = itr.get_prev(datetime.datetime)
             
         lookback_delta = datetime.timedelta(seconds=self.lookback_seconds)
+        self.cache.prune(str(now - lookback_delta))
+        self.crawler = None # this pass crawls the tweets since the last one, then continues below the cache
         while index_ts > now - lookback_delta:
             if str(index_ts)[:len_to_keep] not in existing_tss:
                 missing_tss.add(index_ts)
@@ -108,52 +171,57 @@ class TwitterSensor(treldev.Sensor):
                                 'instance_ts_precision':self.instance_ts_precision,
                                 'locking_seconds': self.locking_seconds }
 
+    def fill_cache(self, ts, ts_next):
+        ''' Crawls until the cache holds every tweet between ts and ts_next, or ``max_tweets`` tweets were crawled for it. The crawl pages back from now, jumps below the ranges earlier crawls cached and is kept for the next, older, instance, so a backfill crawls each tweet once. Only a crawl that runs out of tweets records that there are none older. '''
+        num_tweets = 0
+        while not self.cache.covers(str(ts), str(ts_next)):
+            if num_tweets >= self.max_tweets:
+                self.logger.warning(f"stopped after crawling {num_tweets} tweets for {ts}, older tweets of it may be missing")
+                break
+            if self.crawler is None:
+                crawl_start = str(datetime.datetime.now())
+                if self.debug:
+                    self.logger.debug(f"new crawl back from {crawl_start} for {ts}")
+                self.crawl_range = self.cache.add_range(crawl_start, crawl_start, None)
+                self.crawler = crawl(self.hashtag, json.loads(self.credentials['twitter']), logger=self.logger, max_tweets=self.max_tweets - num_tweets)
+            try:
+                _, tweet = next(self.crawler)
+            except StopIteration as stop:
+                self.crawler = None
+                if stop.value:
+                    self.cache.complete(self.crawl_range)
+                continue
+            if self.debug and 'tweet' in self.debug:
+                self.logger.debug(f"tweet: {tweet}")
+            older = self.cache.add(tweet, self.crawl_range)
+            if older is not None:
+                start_ts, min_id = older
+                if self.debug:
+                    self.logger.debug(f"reached the cache at {tweet['created_ts']}, continuing below {start_ts}")
+                self.crawler = None if start_ts == '' else crawl(self.hashtag, json.loads(self.credentials['twitter']), logger=self.logger, max_id=min_id - 1,
+                                                                 max_tweets=self.max_tweets - num_tweets - 1)
+            num_tweets += 1
+            if num_tweets % 100 == 0:
+                self.cache.commit()
+        self.cache.commit()
+        if self.debug:
+            self.logger.debug(f"crawled {num_tweets} tweets for {ts}")
+
     def save_data_to_path(self, load_info, uri):
         ''' if the previous call to get_new_datasetspecs returned a (load_info, datasetspec) tuple, then this call should save the data to the provided path, given the corresponding (load_info, path). '''
         ts = load_info
         ts_next = croniter.croniter(self.cron_constraint, ts).get_next(datetime.datetime)
         if self.debug:
             self.logger.debug(f"ts {ts} ts_next {ts_next}")
-        self.write_last_tweet = False
-        if getattr(self, 'crawler',None) is not None and hasattr(self,'last_tweet') and self.last_tweet['created_ts'] >= str(ts):
-            # crawler is good enough
-            if self.debug:
-                self.logger.debug(f"reuse crawler as self.last_tweet['created_ts'] = {self.last_tweet['created_ts']} >= ts = {ts}")
-            self.write_last_tweet = True
-        else:
-            # reset the crawler
-            if self.debug:
-                self.logger.debug(f"new crawler as crawler = {getattr(self, 'crawler',None)} self.last_tweet['created_ts'] = {self.last_tweet['created_ts'] if getattr(self,'last_tweet',None) else None} < ts = {ts}")
-            self.crawler = crawl(self.hashtag, json.loads(self.credentials['twitter']), until=ts_next, logger=self.logger, max_tweets=10000)
+        self.fill_cache(ts, ts_next)
         folder = tempfile.mkdtemp()
         if self.debug:
             self.logger.debug(f"folder: {folder}")
         
         with open(folder+'/part-00000','w') as f:
-            if self.write_last_tweet:
-                if self.last_tweet['created_ts'] >= str(ts):
-                    json.dump(self.last_tweet, f)
-                    f.write('\n')
-            while True:
-                try:
-                    _, self.last_tweet = next(self.crawler)
-                    if self.debug and 'tweet' in self.debug:
-                        self.logger.debug(f"tweet: {self.last_tweet}")
-                    if self.last_tweet['created_ts'] >= str(ts_next):
-                        if self.debug and 'tweet_ts' in self.debug:
-                            self.logger.debug(f"tweet: {self.last_tweet['created_ts']} > {str(ts_next)}. continuing")
-                        continue
-                    if self.last_tweet['created_ts'] >= str(ts):
-                        json.dump(self.last_tweet, f)
-                        f.write('\n')
-                    else:
-                        if self.debug:
-                            self.logger.debug(f"tweet: {self.last_tweet['created_ts']} < {str(ts)}. breaking")
-                        break
-                except StopIteration:
-                    self.crawler = None
-                    self.last_tweet = None
-                    break
+            for tweet in self.cache.tweets(str(ts), str(ts_next)):
+                json.dump(tweet, f)
+                f.write('\n')
                 
         s3_commands = treldev.S3Commands(credentials=self.credentials)
         assert uri.endswith('/')